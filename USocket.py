@@ -1,9 +1,15 @@
 from socket import socket, AF_INET, SOCK_DGRAM, inet_aton, inet_ntoa
+from collections import deque
+import threading
 import time
 
-sockets = {}
 network = ('127.0.0.1', 12345)
 
+BURST_TIME = 0.1  # rate 模式下令牌桶最多攒多少秒的量
+MIN_BURST = 1 << 13  # 桶至少能装下一个最大的包 (rdt 的包不超过 RECV_BUFFER_SIZE)，不然大包永远发不出去
+QUEUE_LIMIT = 0  # 令牌不够的数据包最多排多少 byte，排着的包 rdt 的 RTO 跟不上，会超时再重传一遍，实测不如直接丢
+CONTROL_SIZE = 256  # 这么小的包 (SYN/FIN/ACK 都是) 总是排队，不丢
+
 
 def bytes_to_addr(bytes):
     return inet_ntoa(bytes[:4]), int.from_bytes(bytes[4:8], 'big')
@@ -13,51 +19,129 @@ def addr_to_bytes(addr):
     return inet_aton(addr[0]) + addr[1].to_bytes(4, 'big')
 
 
-def get_sendto(id, rate=None):
-    if rate:
-        def sendto(data: bytes, addr):
-            time.sleep(len(data) / rate)
-            sockets[id].sendto(addr_to_bytes(addr) + data, network)
+class UnreliableSocket:
+    """
+    发包前面加 8 byte 的目的地址发给 network，收包去掉 8 byte 的来源地址
 
-        return sendto
-    else:
-        def sendto(data: bytes, addr):
-            sockets[id].sendto(addr_to_bytes(addr) + data, network)
+    每个包都要走的路径上尽量不做多余的事: socket 直接放在对象上，不每次查全局的 dict；
+    地址和 8 byte 地址头两个方向都缓存起来，不每个包 inet_aton/inet_ntoa 一遍；不是 network 发来的包在循环里跳过，不递归
 
-        return sendto
+    试过 sendmsg([地址头, payload]) 和 recvfrom_into 预先分配的 buffer，在 CPython 里反而更慢:
+    8 KB 以内拼一下 bytes 比 sendmsg 建 iovec 便宜，payload 要放进 ready 里留着，recvfrom_into 之后还得再拷一份出来
 
+    rate 不再在发送线程里 sleep (会把计时器和回 ack 一起卡住)，改成令牌桶: 令牌够就直接发，不够的包按顺序排队，
+    由一个 shaper 线程等令牌攒够了再发出去，sendto() 从不阻塞。
+    小的控制包 (SYN/FIN/ACK) 总是排上，握手、挥手和回 ack 不会因为限速丢；数据包最多排 QUEUE_LIMIT byte，排不下的丢掉，
+    跟限速链路的 buffer 满了一样，由 rdt 重传、拥塞控制降下来
+    """
 
-class UnreliableSocket:
     def __init__(self, rate=None):
         assert rate is None or rate > 0, 'Rate should be positive or None.'
-        sockets[id(self)] = socket(AF_INET, SOCK_DGRAM)
-        self.sendto = get_sendto(id(self), rate)
+        self._sock = socket(AF_INET, SOCK_DGRAM)
+        self._prefixes = {}  # addr -> 8 byte 地址头
+        self._addrs = {}  # 8 byte 地址头 -> addr
+        self._rate = rate
+        if rate:
+            self._burst = max(rate * BURST_TIME, MIN_BURST)
+            self._tokens = self._burst
+            self._refilled = time.monotonic()
+            self._shaped = deque()  # 令牌不够、排队等着发的 (data, addr)
+            self._shaped_size = 0  # 队列里一共多少 byte
+            self._shaper = threading.Condition()
+            self._shaper_closed = False
+            threading.Thread(target=self._shape, daemon=True).start()
+            self.sendto = self._sendto_limited
+        else:
+            self.sendto = self._sendto
+
+    def _prefix(self, addr) -> bytes:
+        prefix = self._prefixes.get(addr)
+        if prefix is None:
+            prefix = self._prefixes[addr] = addr_to_bytes(addr)
+        return prefix
+
+    def _sendto(self, data: bytes, addr):
+        self._sock.sendto(self._prefix(addr) + data, network)
+
+    def _refill(self, size) -> float:
+        """补令牌，够发 size 就扣掉返回 0，不够返回还要等几秒 (要拿着 _shaper)"""
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled) * self._rate)
+        self._refilled = now
+        size = min(size, self._burst)  # 比桶还大的包攒满就发，不然永远发不出去
+        if self._tokens < size:
+            return (size - self._tokens) / self._rate
+        self._tokens -= size
+        return 0
+
+    def _sendto_limited(self, data: bytes, addr):
+        with self._shaper:
+            size = len(data)
+            if self._shaped or self._refill(size):  # 前面还有在排队的就跟在后面，不插队
+                if size > CONTROL_SIZE and self._shaped_size + size > QUEUE_LIMIT:
+                    return
+                # rdt 的数据包是每个线程重复用的 encode 缓冲区上的 memoryview，下一次 encode 就改掉了，排队的要拷一份
+                self._shaped.append((bytes(data), addr))
+                self._shaped_size += size
+                self._shaper.notify()
+                return
+        self._sendto(data, addr)
+
+    def _shape(self):
+        """shaper 线程: 按令牌把排队的包一个个放出去"""
+        while True:
+            with self._shaper:
+                while not self._shaped and not self._shaper_closed:
+                    self._shaper.wait()
+                if self._shaper_closed:
+                    return
+                data, addr = self._shaped[0]
+                delay = self._refill(len(data))
+                if delay:
+                    self._shaper.wait(delay)
+                    continue
+                self._shaped.popleft()
+                self._shaped_size -= len(data)
+            try:
+                self._sendto(data, addr)
+            except OSError:  # socket 已经关了
+                return
 
     def bind(self, address: (str, int)):
-        sockets[id(self)].bind(address)
+        self._sock.bind(address)
 
     def recvfrom(self, bufsize) -> bytes:
-        data, frm = sockets[id(self)].recvfrom(bufsize)
-        addr = bytes_to_addr(data[:8])
-        if frm == network:
-            return data[8:], addr
-        else:
-            return self.recvfrom(bufsize)
+        while True:
+            data, frm = self._sock.recvfrom(bufsize)
+            if frm == network:
+                break
+        prefix = data[:8]
+        addr = self._addrs.get(prefix)
+        if addr is None:
+            addr = self._addrs[prefix] = bytes_to_addr(prefix)
+        return data[8:], addr
 
     def settimeout(self, value):
-        sockets[id(self)].settimeout(value)
+        self._sock.settimeout(value)
 
     def gettimeout(self):
-        return sockets[id(self)].gettimeout()
+        return self._sock.gettimeout()
 
     def setblocking(self, flag):
-        sockets[id(self)].setblocking(flag)
+        self._sock.setblocking(flag)
 
     def getblocking(self):
-        sockets[id(self)].getblocking()
+        return self._sock.getblocking()
+
+    def fileno(self):
+        return self._sock.fileno()
 
     def getsockname(self):
-        return sockets[id(self)].getsockname()
+        return self._sock.getsockname()
 
     def close(self):
-        sockets[id(self)].close()
+        if self._rate:
+            with self._shaper:
+                self._shaper_closed = True
+                self._shaper.notify()
+        self._sock.close()
@@ -0,0 +1,379 @@
+"""
+asyncio 版本的 RDT socket
+
+rdt.py 里全是阻塞调用，每个连接至少一个 dispatcher 线程，还要再开线程跑 send/recv。
+AsyncRDTSocket 跑在 asyncio 的事件循环里，用 loop.create_datagram_endpoint 收发 UDP，不开任何线程，
+一个事件循环里可以同时跑几千个连接:
+
+    server = AsyncRDTSocket()
+    await server.bind(('127.0.0.1', 9999))
+    conn, addr = await server.accept()
+    data = await conn.recv(2048)
+    await conn.send(data)
+    await conn.close()
+
+    client = AsyncRDTSocket()
+    await client.connect(('127.0.0.1', 9999))
+
+包的格式 (Segment) 和 network.py 的 8 byte 地址头都跟 rdt.py/USocket.py 一样，所以两边可以混着用。
+收到包之后的 SR 逻辑 (on_ack, detect_losses, on_timeout, on_data, on_fin ...) 直接用 RDTSocket 的，
+它们只用到 self._sender/_receiver/_scheduler/_rto/_cc 和 self.sendto，这里的 _scheduler 换成了 loop.call_later 版本的。
+server 这边跟 RDTSocket(multiplex=True) 一样，所有连接都走 bind 的那一个端口，按 header 里的 conn_id 分给各个连接。
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+
+import rdt
+from USocket import network, addr_to_bytes, bytes_to_addr
+from congestion import create_congestion_controller
+from compression import parse_compression, offer
+from rdt import RDTSocket, Segment, SenderState, ReceiverState, RTOEstimator, MSSProber, FECController
+
+
+class LoopScheduler:
+    """
+    TimerScheduler 的 asyncio 版本，接口一样 (schedule, cancel, close)，用 loop.call_later，不开线程
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._handles = {}  # key -> TimerHandle
+        self._closed = False
+
+    def schedule(self, key, delay, callback):
+        if self._closed:
+            return
+        old = self._handles.get(key)
+        if old:
+            old.cancel()
+        self._handles[key] = self._loop.call_later(delay, self._fire, key, callback)
+
+    def _fire(self, key, callback):
+        del self._handles[key]
+        callback(key)
+
+    def cancel(self, key):
+        handle = self._handles.pop(key, None)
+        if handle:
+            handle.cancel()
+
+    def close(self):
+        self._closed = True
+        for handle in self._handles.values():
+            handle.cancel()
+        self._handles.clear()
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, owner: "AsyncRDTSocket"):
+        self.owner = owner
+
+    def datagram_received(self, data: bytes, frm):
+        if frm != network:
+            return
+        addr = bytes_to_addr(data[:8])
+        data = data[8:]
+        # checksum 不对，或者 header 不完整 (比 header 短、扩展坏了)，直接丢弃，等对面超时重发
+        segment = Segment.decode(data) if Segment.check_checksum(data) else None
+        if segment is None:
+            if rdt.DEBUG:
+                print("Received corrupted data")
+            return
+        # 异常漏到 loop 里 transport 就被关了，一个包处理出错只丢这个包
+        try:
+            self.owner.on_segment(segment, addr)
+        except Exception as e:
+            if rdt.DEBUG:
+                print("Dropped malformed segment: " + repr(e))
+
+
+class AsyncRDTSocket:
+    """
+    跟 RDTSocket 一样的用法，只是 bind/connect/accept/send/recv/close 都要 await
+    """
+
+    DUPACK_THRESHOLD = RDTSocket.DUPACK_THRESHOLD
+    FIN_RETRIES = RDTSocket.FIN_RETRIES
+    TIME_WAIT = RDTSocket.TIME_WAIT
+
+    def __init__(self, congestion="reno", fec=False, compression="auto"):
+        self._loop = None
+        self._transport = None
+        self._listener = None  # accept() 出来的连接: 收发都走 server 的端口
+        self._scheduler = None  # bind 之后才有 loop
+
+        self._connect_addr = None
+        self._conn_id = 0
+        self._version = Segment.LEGACY_VERSION
+        self._sender = None
+        self._receiver = None
+        self._fin_acked = threading.Event()  # RDTSocket.handle_segment 里会 set
+        self._peer_closed = False
+        self._closed = False
+        self._rto = RTOEstimator()
+        self._cc = create_congestion_controller(congestion)
+        self._mss = MSSProber()
+        self._fec = FECController(fec)
+        self._compression = compression
+        self._algorithm, self._auto_compress = parse_compression(compression)
+        self._compressor = None
+        self._wakeup = None  # send()/recv()/close() 等着的 future，这个连接收到包就 set
+        self._synack = None  # connect() 等 synack 的 future
+
+        # server (没有 connect 的 socket) 用
+        self._connections = {}  # conn_id -> AsyncRDTSocket
+        self._addresses = {}  # client 地址 -> conn_id
+        self._accept_queue = None
+        self._conn_ids = itertools.count(1)
+
+    # 收到包之后的 SR 逻辑跟 RDTSocket 完全一样
+    handle_segment = RDTSocket.handle_segment
+    on_ack = RDTSocket.on_ack
+    detect_losses = RDTSocket.detect_losses
+    watch_window = RDTSocket.watch_window
+    probe_window = RDTSocket.probe_window
+    send_mss_probe = RDTSocket.send_mss_probe
+    on_mss_probe_ack = RDTSocket.on_mss_probe_ack
+    on_timeout = RDTSocket.on_timeout
+    on_data = RDTSocket.on_data
+    on_parity = RDTSocket.on_parity
+    send_data_ack = RDTSocket.send_data_ack
+    on_fin = RDTSocket.on_fin
+    send_segment = RDTSocket.send_segment
+    piggyback_ack = RDTSocket.piggyback_ack
+    will_send = RDTSocket.will_send
+    add_parity = RDTSocket.add_parity
+    negotiate_compression = RDTSocket.negotiate_compression
+    congestion_control = RDTSocket.congestion_control
+    rto = RDTSocket.rto
+    mss = RDTSocket.mss
+    fec = RDTSocket.fec
+    srtt = RDTSocket.srtt
+    rttvar = RDTSocket.rttvar
+
+    async def bind(self, address: (str, int)):
+        self._loop = asyncio.get_running_loop()
+        self._transport, _ = await self._loop.create_datagram_endpoint(lambda: _DatagramProtocol(self),
+                                                                       local_addr=address)
+        self._scheduler = LoopScheduler(self._loop)
+
+    def sendto(self, data: bytes, addr: (str, int)):
+        self._transport.sendto(addr_to_bytes(addr) + data, network)
+
+    def getsockname(self):
+        return self._transport.get_extra_info("sockname")
+
+    def on_segment(self, segment: Segment, addr):
+        """bind 的那个端口上收到的每一个包"""
+        if self._synack is not None:  # connect() 还在等 synack
+            if segment.is_synack_handshake() and not self._synack.done():
+                self._synack.set_result((addr, segment))
+            return
+
+        if self._connect_addr is not None:  # client
+            if addr == self._connect_addr:
+                self.handle_segment(segment)
+                self._notify()
+            return
+
+        # server
+        if segment.is_syn_handshake():
+            self.on_syn(segment, addr)
+            return
+        conn = self._connections.get(segment.conn_id)
+        if conn is None or conn._connect_addr != addr:
+            if segment.is_fin_handshake():  # 连接已经关了，是对面没收到我们的 ack 又重发的 fin
+                self.sendto(Segment.ack_handshake(conn_id=segment.conn_id).encode(segment.version), addr)
+            return
+        conn.handle_segment(segment)
+        conn._notify()
+
+    def on_syn(self, syn: Segment, addr):
+        conn_id = self._addresses.get(addr)
+        if conn_id is None:
+            if self._closed:
+                return
+            conn_id = next(self._conn_ids)
+            conn = AsyncRDTSocket(congestion=type(self._cc), fec=self._fec.enabled, compression=self._compression)
+            conn._loop, conn._transport, conn._listener = self._loop, self._transport, self
+            conn._scheduler = LoopScheduler(self._loop)
+            conn._connect_addr, conn._conn_id = addr, conn_id
+            conn._mss.max_mss = min(syn.mss_option(), Segment.MAX_MSS)
+            conn._version = min(syn.max_version, Segment.VERSION)
+            conn._start()
+            conn.negotiate_compression(syn.compression)
+            self._connections[conn_id] = conn
+            self._addresses[addr] = conn_id
+            self._queue().put_nowait(conn)
+        # 同一个地址重发的 syn 只重回 synack
+        conn = self._connections[conn_id]
+        synack = Segment.synack_handshake(conn_id=conn_id, mss=conn._mss.max_mss, compression=offer(conn._algorithm))
+        self.sendto(synack.encode(conn._version), addr)
+
+    def _queue(self) -> asyncio.Queue:
+        if self._accept_queue is None:
+            self._accept_queue = asyncio.Queue()
+        return self._accept_queue
+
+    def _start(self):
+        self._sender = SenderState(conn_id=self._conn_id)
+        self._receiver = ReceiverState()
+
+    def _notify(self):
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    async def _wait(self, timeout=None):
+        """等到这个连接收到下一个包，最多等 timeout 秒"""
+        if self._wakeup is None or self._wakeup.done():
+            self._wakeup = self._loop.create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._wakeup), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def accept(self) -> ("AsyncRDTSocket", (str, int)):
+        conn = await self._queue().get()
+        if rdt.DEBUG:
+            print("Accept OK")
+        return conn, conn._connect_addr
+
+    async def connect(self, addr: (str, int)):
+        if self._transport is None:
+            await self.bind(('127.0.0.1', 0))
+
+        # 发 syn 等 synack，等一个 RTO 没等到就重发 (RTO 指数退避)
+        syn = Segment.syn_handshake(mss=Segment.MAX_MSS, compression=offer(self._algorithm)).encode()
+        retransmitted = False
+        while True:
+            self._synack = self._loop.create_future()
+            sent_time = time.monotonic()
+            self.sendto(syn, addr)
+            try:
+                peer, synack = await asyncio.wait_for(self._synack, self._rto.rto)
+                break
+            except asyncio.TimeoutError:
+                self._rto.on_timeout(sent_time)
+                retransmitted = True
+        if not retransmitted:  # 握手也是一个 RTT 样本，重发过 syn 的不要 (Karn)
+            self._rto.on_sample(time.monotonic() - sent_time)
+
+        self._synack = None
+        self._connect_addr, self._conn_id = peer, synack.conn_id
+        self._mss.max_mss = min(synack.mss_option(), Segment.MAX_MSS)
+        self._version = synack.version
+        self._start()
+        self.negotiate_compression(synack.compression)
+        if rdt.DEBUG:
+            print("Connect OK")
+
+    async def send(self, data: bytes):
+        assert self._connect_addr, "Connection not established yet."
+
+        sender = self._sender
+        total = len(memoryview(data).cast("B"))
+        frames = self._compressor.frames(data) if self._compressor else iter([(data, total)])
+        pending = next(frames, None)
+        consumed = 0
+
+        # 跟 RDTSocket.send() 一样的 SR 流程，窗口满了、pacing 没到点的时候 await 下一个包
+        # 压缩的话前面的帧都交给 sender 了再压下一块，见 RDTSocket.send_stream
+        while True:
+            if not sender.has_unsent() and pending is not None:
+                with sender.lock:
+                    sender.push(pending[0])
+                consumed = pending[1]
+                pending = next(frames, None)
+                continue
+            if sender.idle():
+                break
+            if self._peer_closed:
+                raise BrokenPipeError("Connection closed by peer")
+            if not sender.has_unsent() or sender.next_seq_num >= sender.send_limit(self._cc.cwnd):
+                await self._wait()
+                continue
+            now = time.monotonic()
+            if now < sender.next_send_time:
+                await self._wait(sender.next_send_time - now)
+                continue
+
+            with sender.lock:
+                seq = sender.new_segment()
+                sender.send_times[seq % sender.capacity] = now
+                parity = self.add_parity(seq, consumed == total)
+                pacing_rate = self._cc.pacing_rate
+                if pacing_rate:
+                    sender.next_send_time = max(sender.next_send_time, now - 1 / pacing_rate) + 1 / pacing_rate
+            self._scheduler.schedule(seq, self._rto.rto, self.on_timeout)
+            self.send_segment(seq)
+            if parity:
+                self.sendto(parity.encode(self._version), self._connect_addr)
+
+    async def recv(self, bufsize: int) -> bytes:
+        assert self._connect_addr, "Connection not established yet."
+
+        receiver = self._receiver
+        while not receiver.ready and not receiver.eof:
+            await self._wait()
+        with receiver.lock:
+            data = b"".join(receiver.take(bufsize))
+            if not data and receiver.error is not None:
+                raise receiver.error
+            reopened = receiver.reopened()
+        if reopened:
+            self.send_data_ack()
+        return data
+
+    async def recv_into(self, buffer, nbytes: int = 0) -> int:
+        assert self._connect_addr, "Connection not established yet."
+
+        receiver = self._receiver
+        while not receiver.ready and not receiver.eof:
+            await self._wait()
+        with receiver.lock:
+            nbytes = receiver.read_into(memoryview(buffer).cast("B")[:nbytes or None])
+            if not nbytes and receiver.error is not None:
+                raise receiver.error
+            reopened = receiver.reopened()
+        if reopened:
+            self.send_data_ack()
+        return nbytes
+
+    async def close(self):
+        if self._connect_addr is None:
+            # server: 不再接受新连接，最后一个连接关了再关端口
+            self._closed = True
+            if self._transport is not None and not self._connections:
+                self._transport.close()
+            return
+
+        if not self._closed and not self._peer_closed:
+            self._scheduler.cancel("ack")
+            fin = Segment.fin_handshake(ack_num=self._receiver.recv_base, conn_id=self._conn_id).encode(self._version)
+            for _ in range(self.FIN_RETRIES):
+                self.sendto(fin, self._connect_addr)
+                deadline = time.monotonic() + self._rto.rto
+                while not self._fin_acked.is_set() and time.monotonic() < deadline:
+                    await self._wait(deadline - time.monotonic())
+                if self._fin_acked.is_set():
+                    break
+
+        self._closed = True
+        self._scheduler.close()
+        if self._listener is not None:
+            self._listener._remove(self)  # server 的端口会直接回已经关掉的连接重发的 fin
+        elif self._peer_closed:
+            # 对面先关: 不用等，TIME_WAIT 之后再关端口，这段时间对面重发的 fin 还会在 on_segment 里回
+            self._loop.call_later(self.TIME_WAIT, self._transport.close)
+        else:
+            self._transport.close()
+
+    def _remove(self, conn: "AsyncRDTSocket"):
+        self._connections.pop(conn._conn_id, None)
+        if self._addresses.get(conn._connect_addr) == conn._conn_id:
+            del self._addresses[conn._connect_addr]
+        if self._closed and not self._connections:
+            self._transport.close()
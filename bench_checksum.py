@@ -0,0 +1,96 @@
+"""
+checksum 的 micro-benchmark: 比较以前 zip(i, i) 逐字节求和的写法和现在 int.from_bytes 折叠的写法
+每个包都是满的 (MAX_PAYLOAD_SIZE)，测 encode+check_checksum+decode 一整轮每秒能处理多少个 segment
+compact 是同样的一轮换成 15 byte 的新 header
+
+python bench_checksum.py
+"""
+
+import os
+import struct
+import time
+
+import rdt
+from rdt import Segment
+
+rdt.DEBUG = False
+
+
+def legacy_calculate_checksum(segment: Segment) -> int:
+    temp = bytearray(struct.pack("!???IIII", segment.syn, segment.fin, segment.ack, segment.seq_num, segment.ack_num,
+                                 segment.length, segment.conn_id))
+    if segment.payload:
+        temp.extend(segment.payload)
+    i = iter(temp)
+    bytes_sum = sum((a << 8) + b for a, b in zip(i, i))
+    if len(temp) % 2 == 1:
+        bytes_sum += temp[-1] << 8
+    bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
+    bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
+    return ~bytes_sum & 0xFFFF
+
+
+def legacy_check_checksum(data: bytes) -> bool:
+    i = iter(data)
+    bytes_sum = sum((a << 8) + b for a, b in zip(i, i))
+    if len(data) % 2 == 1:
+        bytes_sum += data[-1] << 8
+    bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
+    bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
+    return bytes_sum & 0xFFFF == 0xFFFF
+
+
+def legacy_encode(segment: Segment) -> bytes:
+    segment.checksum = legacy_calculate_checksum(segment)
+    data = bytearray(struct.pack("!H???IIII", segment.checksum, segment.syn, segment.fin, segment.ack,
+                                 segment.seq_num, segment.ack_num, segment.length, segment.conn_id))
+    if segment.payload:
+        data.extend(segment.payload)
+    return bytes(data)
+
+
+def legacy_decode(data: bytes) -> Segment:
+    checksum, syn, fin, ack, seq_num, ack_num, length, conn_id = struct.unpack("!H???IIII", data[:21])
+    return Segment(syn, fin, ack, seq_num, ack_num, length, checksum, data[21:], conn_id)
+
+
+def legacy_round_trip(segment: Segment):
+    data = legacy_encode(segment)
+    assert legacy_check_checksum(data)
+    legacy_decode(data)
+
+
+def round_trip(segment: Segment):
+    data = segment.encode()
+    assert Segment.check_checksum(data)
+    Segment.decode(data)
+
+
+def compact_round_trip(segment: Segment):
+    data = segment.encode(Segment.VERSION)
+    assert Segment.check_checksum(data)
+    Segment.decode(data)
+
+
+def bench(name, fn, segment, seconds=2.0):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for _ in range(100):
+            fn(segment)
+        count += 100
+    rate = count / (time.perf_counter() - start)
+    print(f"{name:<8} {rate:>12.0f} segments/s")
+    return rate
+
+
+if __name__ == '__main__':
+    payload = os.urandom(Segment.MAX_PAYLOAD_SIZE)
+    segment = Segment(seq_num=1234, length=len(payload), payload=payload, conn_id=42)
+    assert legacy_encode(segment) == segment.encode()  # 两种写法编出来的字节流必须一模一样
+
+    before = bench("before", legacy_round_trip, segment)
+    after = bench("after", round_trip, segment)
+    compact = bench("compact", compact_round_trip, segment)
+    print(f"speedup  {after / before:>12.1f}x")
+    print(f"compact  {compact / before:>12.1f}x")
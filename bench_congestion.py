@@ -0,0 +1,56 @@
+"""
+用同一份数据比较几种拥塞控制，先在另一个终端跑 python network.py
+
+python bench_congestion.py                # reno cubic bbr 都跑一遍
+python bench_congestion.py cubic bbr      # 只跑指定的
+"""
+
+import sys
+import threading
+import time
+
+import rdt
+from congestion import CONGESTION_CONTROLLERS
+from rdt import RDTSocket
+
+rdt.DEBUG = False
+
+
+def bench(name, data, port):
+    server = RDTSocket(congestion=name)
+    server.bind(('127.0.0.1', port))
+    received = bytearray()
+
+    def serve():
+        conn, addr = server.accept()
+        while True:
+            chunk = conn.recv(len(data))
+            if not chunk:
+                break
+            received.extend(chunk)
+        conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    client = RDTSocket(congestion=name)
+    client.connect(('127.0.0.1', port))
+    start = time.perf_counter()
+    client.send(data)
+    elapsed = time.perf_counter() - start
+    cc = client.congestion_control
+    client.close()
+    thread.join()
+    server.close()
+
+    assert received == data, "data corrupted"
+    print(f"{name:<6} {len(data)}bytes in {elapsed:.2f}s  {len(data) / elapsed / 1024:.1f}KB/s  "
+          f"cwnd={cc.cwnd:.1f}  rto={client.rto:.3f}s")
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(CONGESTION_CONTROLLERS)
+    with open('alice.txt', 'rb') as f:
+        data = f.read()
+    for i, name in enumerate(names):
+        bench(name, data, 9900 + i)
@@ -0,0 +1,150 @@
+"""
+payload 压缩
+
+network.py 默认限速 10240 byte/s，alice.txt 这种文本压一下能小好几倍，在慢的链路上就快好几倍。
+压缩是在分段之前对字节流做的，SR 那一层完全不知道: 发送方把 send() 的数据按 BLOCK_SIZE 切块，每块压成一帧接在流后面，
+接收方按顺序收到的数据先过一遍 StreamDecompressor 再放进 ready
+
+    帧 = kind (1 byte) + length (4 byte) + length byte 的 body
+    kind: RAW 没压缩，ZLIB 整个连接共用一个 zlib 流 (每帧 Z_SYNC_FLUSH，字典一直接着用)，LZMA 每帧一个独立的 xz
+
+握手的时候每一边带一个 byte (offer): 低 4 位是自己能解哪些 (SUPPORTED)，高 4 位是自己想用哪个压。
+一个方向上只有发送方想压而且接收方能解才压，不然这个方向上就是原来的字节流，不分帧 (所以跟老版本说话的时候什么都不变)
+
+    None     不压
+    "zlib"   每块都用 zlib 压
+    "lzma"   每块都用 lzma 压，压得更小但是慢很多，适合特别慢的链路
+    "auto"   zlib，但是每块先拿开头 SAMPLE_SIZE 个 byte 用最快的级别试一下，压不到 MIN_RATIO 以下就不压 (已经压过的文件、随机数据)
+"""
+
+import lzma
+import struct
+import zlib
+
+RAW = 0
+ZLIB = 1
+LZMA = 2
+
+ALGORITHMS = {"zlib": ZLIB, "lzma": LZMA}
+SUPPORTED = 1 << ZLIB | 1 << LZMA  # 能解的算法，一个算法一位
+
+FRAME = struct.Struct("!BI")  # kind, body 长度
+BLOCK_SIZE = 1 << 16  # 多少 byte 压成一帧
+SAMPLE_SIZE = 4096
+MIN_RATIO = 0.9
+
+
+def parse_compression(compression) -> (int, bool):
+    """
+    compression 可以是 None, "zlib", "lzma", "auto"，返回 (算法, 要不要先试一下压不压得动)
+    """
+    if not compression:
+        return RAW, False
+    if compression == "auto":
+        return ZLIB, True
+    if compression not in ALGORITHMS:
+        raise ValueError("Unknown compression: " + str(compression))
+    return ALGORITHMS[compression], False
+
+
+def offer(algorithm: int) -> int:
+    """握手的时候带的那个 byte"""
+    return algorithm << 4 | SUPPORTED
+
+
+def negotiate(algorithm: int, peer_offer) -> (int, int):
+    """
+    algorithm 是我们想用的，peer_offer 是对面握手带的 (老版本没有，是 None)
+    返回 (我们发的时候用什么压, 对面发过来的是用什么压的)，RAW 表示这个方向不分帧
+    """
+    if peer_offer is None:
+        return RAW, RAW
+    send = algorithm if peer_offer & 1 << algorithm and algorithm != RAW else RAW
+    peer_algorithm = peer_offer >> 4
+    recv = peer_algorithm if SUPPORTED & 1 << peer_algorithm and peer_algorithm != RAW else RAW
+    return send, recv
+
+
+class StreamCompressor:
+    """
+    发送方: 把 send() 的数据切块压成帧
+    """
+
+    def __init__(self, algorithm: int, auto: bool = False):
+        self.algorithm = algorithm
+        self.auto = auto
+        self._zlib = zlib.compressobj() if algorithm == ZLIB else None
+
+    def frames(self, data):
+        """按 BLOCK_SIZE 切块，一块一帧，每次 yield (帧, 到这一帧为止用掉了多少 byte 的 data)"""
+        data = memoryview(data).cast("B")
+        for i in range(0, len(data), BLOCK_SIZE):
+            block = data[i:i + BLOCK_SIZE]
+            yield self.frame(block), i + len(block)
+
+    def frame(self, block) -> bytes:
+        if self.auto and not self.compressible(block):
+            return FRAME.pack(RAW, len(block)) + block
+        if self.algorithm == ZLIB:
+            body = self._zlib.compress(block) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            body = lzma.compress(block)
+        return FRAME.pack(self.algorithm, len(body)) + body
+
+    @staticmethod
+    def compressible(block) -> bool:
+        """
+        用最快的级别压一下开头，压不动的就不压了
+        不能直接拿连接的 zlib 流试，压进去的东西对面就得解，流已经接不回去了
+        """
+        sample = block[:SAMPLE_SIZE]
+        return len(zlib.compress(sample, 1)) < MIN_RATIO * len(sample)
+
+
+class StreamDecompressor:
+    """
+    接收方: 按顺序收到的数据一段一段喂进来，吐出解压好的数据
+    一帧可能跨好几个包，帧头也可能被切开，所以是个状态机，收到多少解多少
+    """
+
+    def __init__(self):
+        self._header = bytearray()
+        self._kind = RAW
+        self._remaining = 0  # 这一帧还有多少 byte 的 body 没收到
+        self._zlib = zlib.decompressobj()
+        self._lzma = None
+
+    def feed(self, data) -> list:
+        """
+        帧头里不认识的 kind、解不开的 body 抛 ValueError，这之后的流已经接不上了，调用的人不要再喂
+        """
+        chunks = []
+        data = memoryview(data)
+        while data:
+            if not self._remaining:
+                need = FRAME.size - len(self._header)
+                self._header += data[:need]
+                data = data[need:]
+                if len(self._header) < FRAME.size:
+                    break
+                self._kind, self._remaining = FRAME.unpack(self._header)
+                self._header.clear()
+                if self._kind == LZMA:
+                    self._lzma = lzma.LZMADecompressor()
+                elif self._kind not in (RAW, ZLIB):
+                    raise ValueError("Unknown frame kind: " + str(self._kind))
+                continue
+
+            body = data[:self._remaining]
+            data = data[len(body):]
+            self._remaining -= len(body)
+            try:
+                if self._kind == RAW:
+                    chunks.append(body)  # 没压缩的不拷贝
+                elif self._kind == ZLIB:
+                    chunks.append(memoryview(self._zlib.decompress(body)))
+                else:
+                    chunks.append(memoryview(self._lzma.decompress(body)))
+            except (zlib.error, lzma.LZMAError, EOFError) as e:
+                raise ValueError("Corrupted frame: " + str(e)) from e
+        return [chunk for chunk in chunks if len(chunk)]  # 跟 ready 里别的一样是 memoryview，recv() 拿一半的时候不拷贝
@@ -0,0 +1,243 @@
+"""
+拥塞控制
+
+以前拥塞控制是直接写死在 RDTSocket.recv_ack() 和 on_timeout() 里的，现在抽出来，每个连接一个 CongestionController，
+发送方只管在对应的时候通知它，然后按它给的 cwnd (和 pacing_rate) 发包:
+
+    on_ack(acked, now)      确认了 acked 个新包
+    on_loss(timeout, now)   丢包了，timeout=True 是超时，False 是快速重传 (SACK 发现的丢包)
+    on_rtt_sample(rtt)      一个有效的 RTT 样本 (Karn 规则由发送方保证)
+    cwnd                    拥塞窗口，单位是包，可以是小数，发送方向下取整
+    pacing_rate             每秒最多发几个包，None 表示不限速，窗口放行就发
+
+cwnd 的单位是包不是字节，因为 SR 里 seq_num 就是包的下标
+
+现在有三种:
+    reno    慢启动 + 拥塞避免 + 快速恢复，丢包窗口减半，超时降到 1
+    cubic   丢包之后按三次函数涨回去，高 BDP 的链路上比 reno 恢复得快 (RFC 8312)
+    bbr     不看丢包，测瓶颈带宽和最小 RTT，cwnd=2*BDP，按带宽 pacing，适合有随机丢包的链路
+"""
+
+import time
+
+
+class CongestionController:
+    """
+    拥塞控制的接口，子类要实现 on_ack 和 on_loss，cwnd 默认就是 self._cwnd
+    """
+
+    name = None
+
+    def __init__(self, initial_cwnd=1, max_cwnd=1 << 16):
+        self.max_cwnd = max_cwnd
+        self._cwnd = float(initial_cwnd)
+        self.srtt = None
+        self.min_rtt = None
+
+    @property
+    def cwnd(self) -> float:
+        return min(max(self._cwnd, 1.0), self.max_cwnd)
+
+    @property
+    def pacing_rate(self):
+        return None
+
+    def on_ack(self, acked: int, now: float):
+        raise NotImplementedError
+
+    def on_loss(self, timeout: bool, now: float):
+        raise NotImplementedError
+
+    def on_rtt_sample(self, rtt: float):
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+
+
+class Reno(CongestionController):
+    """
+    * cwnd < ssthresh: 慢启动，每确认 1 个包 cwnd+1，也就是每 RTT 翻倍
+    * cwnd >= ssthresh: 拥塞避免，每确认 1 个包 cwnd+1/cwnd，也就是每 RTT +1
+    * 快速重传: ssthresh=cwnd/2, cwnd=ssthresh
+    * 超时: ssthresh=cwnd/2, cwnd=1
+    """
+
+    name = "reno"
+
+    def __init__(self, initial_cwnd=1, max_cwnd=1 << 16, ssthresh=8):
+        super().__init__(initial_cwnd, max_cwnd)
+        self.ssthresh = ssthresh
+
+    def on_ack(self, acked: int, now: float):
+        for _ in range(acked):
+            if self._cwnd < self.ssthresh:
+                self._cwnd += 1
+            else:
+                self._cwnd += 1 / self._cwnd
+
+    def on_loss(self, timeout: bool, now: float):
+        self.ssthresh = max(self._cwnd / 2, 2)
+        self._cwnd = 1 if timeout else self.ssthresh
+
+
+class Cubic(CongestionController):
+    """
+    RFC 8312: 拥塞避免阶段 cwnd 按 W(t) = C*(t-K)^3 + W_max 涨，t 是上一次丢包到现在的时间
+    K = (W_max*(1-BETA)/C)^(1/3) 是涨回 W_max 要的时间，离 W_max 远的时候涨得快，快到的时候变慢，超过之后又加速探测
+    同时算一个 reno 在同样时间能涨到多少 (TCP friendly)，取大的
+    """
+
+    name = "cubic"
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, initial_cwnd=1, max_cwnd=1 << 16, ssthresh=8):
+        super().__init__(initial_cwnd, max_cwnd)
+        self.ssthresh = ssthresh
+        self.w_max = 0.0
+        self.k = 0.0
+        self.epoch_start = None  # 这一轮拥塞避免开始的时间
+        self.w_est = 0.0  # reno 在同样时间下的窗口
+
+    def on_ack(self, acked: int, now: float):
+        for _ in range(acked):
+            if self._cwnd < self.ssthresh:
+                self._cwnd += 1
+                continue
+
+            if self.epoch_start is None:
+                self.epoch_start = now
+                if self._cwnd < self.w_max:
+                    self.k = ((self.w_max - self._cwnd) / self.C) ** (1 / 3)
+                else:
+                    self.k = 0.0
+                    self.w_max = self._cwnd
+                self.w_est = self._cwnd
+
+            rtt = self.srtt or 0.1
+            t = now - self.epoch_start + rtt  # 算一个 RTT 之后应该到多少
+            target = self.C * (t - self.k) ** 3 + self.w_max
+            self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) / self._cwnd
+            target = max(target, self.w_est)
+            if target > self._cwnd:
+                self._cwnd += min(target - self._cwnd, self._cwnd) / self._cwnd  # 每 RTT 最多翻倍
+            else:
+                self._cwnd += 0.01 / self._cwnd
+
+    def on_loss(self, timeout: bool, now: float):
+        # fast convergence: 这次丢包的时候窗口比上次还小，说明别的流在抢带宽，让一点
+        if self._cwnd < self.w_max:
+            self.w_max = self._cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = self._cwnd
+        self.ssthresh = max(self._cwnd * self.BETA, 2)
+        self._cwnd = 1 if timeout else self.ssthresh
+        self.epoch_start = None
+
+
+class BBR(CongestionController):
+    """
+    简化版 BBR: 不把丢包当拥塞信号，而是测两个东西
+        btl_bw  瓶颈带宽，最近 BW_WINDOW 轮里每轮 (一个 min_rtt) 确认速率的最大值，单位 包/秒
+        min_rtt 最近 MIN_RTT_WINDOW 秒里的最小 RTT
+    cwnd = CWND_GAIN * btl_bw * min_rtt (BDP)，pacing_rate = pacing_gain * btl_bw
+
+    STARTUP: pacing_gain=2.89，带宽指数增长，连续 3 轮带宽涨不到 25% 就认为管道满了
+    DRAIN:   pacing_gain=1/2.89，把 STARTUP 里多塞进去的排空
+    PROBE_BW: pacing_gain 在 [1.25, 0.75, 1, 1, 1, 1, 1, 1] 里每轮换一个，探测有没有更多带宽
+    超时的时候才把 cwnd 降下来，快速重传 (随机丢包) 完全不管
+    """
+
+    name = "bbr"
+    HIGH_GAIN = 2.89
+    CWND_GAIN = 2
+    PROBE_GAINS = (1.25, 0.75, 1, 1, 1, 1, 1, 1)
+    BW_WINDOW = 10
+    MIN_RTT_WINDOW = 10.0
+    MIN_CWND = 4
+
+    def __init__(self, initial_cwnd=4, max_cwnd=1 << 16):
+        super().__init__(max(initial_cwnd, self.MIN_CWND), max_cwnd)
+        self.mode = "STARTUP"
+        self.pacing_gain = self.HIGH_GAIN
+        self.btl_bw = 0.0
+        self.bw_samples = []  # 最近几轮的确认速率
+        self.min_rtt_stamp = 0.0
+        self.round_start = None  # 这一轮开始的时间
+        self.round_delivered = 0  # 这一轮确认了几个包
+        self.full_bw = 0.0
+        self.full_bw_count = 0
+        self.cycle_index = 0
+
+    @property
+    def pacing_rate(self):
+        if not self.btl_bw:
+            return None  # 还没测出带宽的时候不限速，靠 cwnd
+        return self.pacing_gain * self.btl_bw
+
+    def on_rtt_sample(self, rtt: float):
+        now = time.monotonic()
+        if self.min_rtt is None or rtt <= self.min_rtt or now - self.min_rtt_stamp > self.MIN_RTT_WINDOW:
+            self.min_rtt = rtt
+            self.min_rtt_stamp = now
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+
+    def on_ack(self, acked: int, now: float):
+        if self.round_start is None:
+            self.round_start = now
+        self.round_delivered += acked
+
+        round_time = max(self.min_rtt or 0.01, 0.001)
+        if now - self.round_start >= round_time:
+            self.end_round(self.round_delivered / (now - self.round_start))
+            self.round_start = now
+            self.round_delivered = 0
+
+        if self.btl_bw and self.min_rtt:
+            bdp = self.btl_bw * self.min_rtt
+            gain = self.HIGH_GAIN if self.mode == "STARTUP" else self.CWND_GAIN
+            self._cwnd = max(gain * bdp, self.MIN_CWND)
+        else:
+            self._cwnd += acked  # 还没有模型的时候跟慢启动一样
+
+    def end_round(self, bw: float):
+        self.bw_samples.append(bw)
+        if len(self.bw_samples) > self.BW_WINDOW:
+            self.bw_samples.pop(0)
+        self.btl_bw = max(self.bw_samples)
+
+        if self.mode == "STARTUP":
+            if self.btl_bw >= self.full_bw * 1.25:
+                self.full_bw = self.btl_bw
+                self.full_bw_count = 0
+            else:
+                self.full_bw_count += 1
+                if self.full_bw_count >= 3:
+                    self.mode = "DRAIN"
+                    self.pacing_gain = 1 / self.HIGH_GAIN
+        elif self.mode == "DRAIN":
+            self.mode = "PROBE_BW"
+            self.cycle_index = 0
+            self.pacing_gain = self.PROBE_GAINS[0]
+        else:
+            self.cycle_index = (self.cycle_index + 1) % len(self.PROBE_GAINS)
+            self.pacing_gain = self.PROBE_GAINS[self.cycle_index]
+
+    def on_loss(self, timeout: bool, now: float):
+        if timeout:
+            self._cwnd = self.MIN_CWND
+
+
+CONGESTION_CONTROLLERS = {cls.name: cls for cls in (Reno, Cubic, BBR)}
+
+
+def create_congestion_controller(congestion) -> CongestionController:
+    """
+    congestion 可以是名字 ("reno", "cubic", "bbr")、CongestionController 的子类或者已经建好的实例
+    """
+    if isinstance(congestion, CongestionController):
+        return congestion
+    if isinstance(congestion, str):
+        if congestion not in CONGESTION_CONTROLLERS:
+            raise ValueError("Unknown congestion control: " + congestion)
+        congestion = CONGESTION_CONTROLLERS[congestion]
+    return congestion()
@@ -7,24 +7,24 @@ GitHub: https://github.com/XDZhelheim/CS305_Project_RDT
 """
 
 from USocket import UnreliableSocket
+from congestion import create_congestion_controller
+from compression import parse_compression, offer, negotiate, StreamCompressor, StreamDecompressor, RAW
 import threading
 import time
 import struct
+import array
 import math
-from fractions import Fraction
+import mmap
+import os
+import socket
+import collections
+import heapq
+import itertools
+import queue
+import selectors
 
 DEBUG = True
 
-# ---这些是 send() 多线程用的 global 变量----------------------------------
-all_segments = []
-send_window_size = 1
-send_base = 0
-next_seq_num = 0
-temp = 0
-num_of_segments = 0
-flags = []
-timers = []
-# ----------------------------------------------------------------------
 
 class RDTSocket(UnreliableSocket):
     """
@@ -41,12 +41,48 @@ class RDTSocket(UnreliableSocket):
 
     """
 
-    def __init__(self, rate=None, debug=True):
+    def __init__(self, rate=None, debug=True, congestion="reno", multiplex=False, fec=False, compression="auto",
+                 nodelay=True):
         super().__init__(rate=rate)
         self._rate = rate
-        self._connect_addr = None
+        self._multiplex = multiplex  # server 用: 所有连接都走这一个端口，见 MultiplexEngine
+        self._mux = None
+        self._accept_queue = None  # listen() 之后才有
+        self._connections = {}  # client 地址 -> conn，重发的 syn 交给同一个 conn
+        self._listener = None  # accept() 出来的 conn 记着是哪个 server 的
+        self._lock = threading.Lock()
+        self._init_connection(TimerScheduler(), congestion, fec, compression, nodelay)
         DEBUG = debug
 
+    def _init_connection(self, scheduler, congestion, fec=False, compression="auto", nodelay=True):
+        self._connect_addr = None
+        self._conn_id = 0  # 单端口多路复用的时候 server 分配的连接号，每个包的 header 里都带着，0 表示每个连接自己一个端口
+        self._version = Segment.LEGACY_VERSION  # header 格式，握手的时候商量
+        self._scheduler = scheduler  # 这个连接所有的重传计时器都归它管
+        self._sender = None  # 连接的发送状态，见 SenderState，连上之后才有
+        self._receiver = None  # 连接的接收状态，见 ReceiverState，连上之后才有
+        self._fin_acked = threading.Event()  # close() 发的 fin 对面确认了
+        self._peer_closed = False  # 收到对面的 fin 了
+        self._closed = False
+
+        self._rto = RTOEstimator()  # 超时阈值按测出来的 RTT 算，整个连接共用
+        self._cc = create_congestion_controller(congestion)  # 拥塞控制，见 congestion.py，每个连接自己一个
+        self._mss = MSSProber()  # 新包切多长，上限握手的时候商量
+        self._fec = FECController(fec)  # 丢包多的时候在数据包后面跟校验包
+        self._compression = compression  # 想怎么压，见 compression.py
+        self._algorithm, self._auto_compress = parse_compression(compression)  # 不认识的在这里就报错
+        self._compressor = None  # 握手之后，对面能解才有
+
+        # nodelay=False 的时候小的 send() 先攒着，见 write()
+        self._nodelay = nodelay
+        self._writes = bytearray()  # 攒着还没发的数据
+        self._writable = threading.Condition()  # 写线程在这上面等数据，flush() 在这上面等写线程
+        self._queued = 0  # send() 一共攒进来多少 byte
+        self._written = 0  # 其中写线程已经发完 (都 ack 了) 多少 byte
+        self._flushing = False  # 有人等着，别攒了马上发
+        self._writer = None  # 写线程，第一次攒数据的时候才开
+        self._write_error = None  # 写线程发的时候对面已经关了，下一次 send()/flush() 报出来
+
     '''
     connect+accept 是握手
 
@@ -73,6 +109,22 @@ class RDTSocket(UnreliableSocket):
         现在不要第三次的 ack 了，TCP 的第三次 ack 就是带数据的，相当于收完 synack 就发数据了，目前版本是两次握手
     '''
 
+    LISTEN_BACKLOG = 128  # 最多有几个握手完了还没被 accept() 拿走的连接，再多的 syn 先不理，client 会重发
+
+    def listen(self, backlog: int = LISTEN_BACKLOG):
+        """
+        开始监听，accept() 的时候没调的话会自动调
+        普通模式开一个线程在 server 的端口上收 syn，多路复用模式建 MultiplexEngine
+        """
+        if self._accept_queue is not None or self._mux is not None:
+            return
+        if self._multiplex:
+            self._mux = MultiplexEngine(self, backlog)
+            return
+        self._accept_queue = queue.Queue(backlog)
+        self.settimeout(self.POLL_INTERVAL)
+        threading.Thread(target=self.listen_syn, daemon=True).start()
+
     def accept(self) -> ('RDTSocket', (str, int)):
         """
         Accept a connection. The socket must be bound to an address and listening for 
@@ -82,101 +134,147 @@ class RDTSocket(UnreliableSocket):
         This function should be blocking. 
         receive syn, send synack, receive ack
         """
+        self.listen()
+        if self._mux is not None:
+            return self._mux.accept()
 
-        conn, addr = RDTSocket(self._rate), None
-        conn.bind(('127.0.0.1', 0))  # 0 表示随机分配端口
+        # 握手是 listen_syn 线程在后台做的，这里直接拿下一个已经回了 synack 的连接
+        conn = self._accept_queue.get()
 
-        data, addr = None, None
-        flag = False  # 要从第一次收到包开始计时，用来标记是否收到第一个包。如果一上来就开始计时那运行到 end_time 那一行之后肯定就超时退出了
-        while True:
-            # 发回去的 synack 可能丢包，这时候 client 会继续发 syn 过来，所以需要一段时间继续监听
-
-            if data and addr:
-                self.setblocking(False)
-                if flag:
-                    start_time = time.time()  # 每次收到 syn 就会重新计时，所以我是收到 syn 之后，如果 1s 内没有再次收到新 syn 就 break
-                    flag = False
-                end_time = time.time()
-                if end_time - start_time > 1:  # 等待这个时间之后就结束
-                    self.setblocking(True)
-                    break
+        if DEBUG:
+            print("Accept OK")
 
+        return conn, conn._connect_addr
+
+    def listen_syn(self):
+        """
+        listen() 开的线程，在 server 的端口上收 syn
+
+        以前 accept() 一次只处理一个 client，回了 synack 还要干等 1s 看有没有重发的 syn，一秒最多建一个连接，
+        而且这 1s 里别的 client 的 syn 也会被当成同一个 conn 的。现在每个地址第一次发 syn 的时候新建一个 conn，
+        放进 accept 队列，同一个地址重发的 syn 只是让对应的 conn 再回一次 synack，
+        所以好几个 client 可以同时握手，accept() 也不用等
+        """
+        while not self._closed:
             # receive syn
             try:
-                data, addr = self.recvfrom(4096)
-            except BlockingIOError:
+                data, addr = self.recvfrom(self.RECV_BUFFER_SIZE)
+            except socket.timeout:
                 continue
+            except OSError:
+                break  # server 已经关了
 
-            if not flag:
-                flag = True
-
-            if not Segment.check_checksum(data):
+            # checksum 不对，或者 header 不完整 (比 header 短、扩展坏了) 的都是坏包
+            syn = Segment.decode(data) if Segment.check_checksum(data) else None
+            if syn is None:
                 if DEBUG:
                     print("Received corrupted data")
                 continue
-            segment = Segment.decode(data)
-
-            # then send synack
-            if segment.is_syn_handshake():
-                conn.sendto(Segment.synack_handshake().encode(), addr)
-                conn.set_connect_addr(addr)  # 连上了，以后就收 addr 发的消息
+            # 这里还没看地址，谁都能发过来，一个包出错只丢这个包，监听线程不能退出
+            try:
+                self.on_listen_segment(syn, addr)
+            except Exception as e:
+                if DEBUG:
+                    print("Dropped malformed segment: " + repr(e))
 
-        if DEBUG:
-            print("Accept OK")
+    def on_listen_segment(self, syn: "Segment", addr):
+        """监听的端口上收到的一个包，是 syn 的话建连接、回 synack"""
+        if not syn.is_syn_handshake():
+            return
 
-        return conn, addr
+        with self._lock:
+            conn = self._connections.get(addr)
+            if conn is None:
+                if self._accept_queue.full():
+                    return
+                conn = RDTSocket(self._rate, congestion=type(self._cc), fec=self._fec.enabled,
+                                 compression=self._compression, nodelay=self._nodelay)
+                conn.bind(('127.0.0.1', 0))  # 0 表示随机分配端口
+                conn._listener = self
+                conn.set_connect_addr(addr)  # 连上了，以后就收 addr 发的消息
+                conn._mss.max_mss = min(syn.mss_option(), Segment.MAX_MSS)
+                conn._version = min(syn.max_version, Segment.VERSION)
+                conn.start(syn.compression)  # client 收到 synack 就开始发数据了，conn 这边要马上开始收
+                self._connections[addr] = conn
+                self._accept_queue.put(conn)
+
+        # then send synack
+        # 发回去的 synack 可能丢包，这时候 client 会继续发 syn 过来，再回一次就行
+        synack = Segment.synack_handshake(mss=conn._mss.max_mss, compression=offer(conn._algorithm))
+        conn.sendto(synack.encode(conn._version), addr)
+
+    def forget(self, conn: "RDTSocket"):
+        """conn 关了，这个地址再来 syn 就是新的连接了"""
+        with self._lock:
+            if self._connections.get(conn._connect_addr) is conn:
+                del self._connections[conn._connect_addr]
 
-    flag = False  # 这个 flag 只在 connect() 和 recv_synack_handshake() 和最后的 fin 里用
     def connect(self, addr: (str, int)):
         """
         Connect to a remote socket at address.
         Corresponds to the process of establishing a connection on the client side.
         send syn, receive synack, send ack
         """
-        self.flag = False
         self.bind(('127.0.0.1', 0))
 
-        threading.Thread(target=self.recv_synack_handshake).start()
-
-        while True:
+        # 发 syn，在 socket 上阻塞等 synack，等一个 RTO 没等到就重发 (RTO 指数退避)，收到 synack 马上返回
+        # 告诉对面我们最多能收多长的包、认识哪些 header 格式、怎么压缩，syn 本身用老格式，老版本的 server 也认识
+        syn = Segment.syn_handshake(mss=Segment.MAX_MSS, compression=offer(self._algorithm)).encode()
+        retransmitted = False
+        synack = None
+        while not self._connect_addr:
             # send syn
-            self.sendto(Segment.syn_handshake().encode(), addr)
+            sent_time = time.monotonic()
+            self.sendto(syn, addr)
+            deadline = sent_time + self._rto.rto
+
+            # receive synack
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.settimeout(remaining)
+                try:
+                    data, addr2 = self.recvfrom(self.RECV_BUFFER_SIZE)  # 这里收到的 synack 是 conn 发过来的，所以 addr2 一定 != addr
+                except socket.timeout:
+                    break
+                segment = Segment.decode(data) if Segment.check_checksum(data) else None
+                if segment is None:
+                    if DEBUG:
+                        print("Received corrupted data")
+                    continue
+                if segment.is_synack_handshake():
+                    self.set_connect_addr(addr2)
+                    self._conn_id = segment.conn_id  # 对面是多路复用的 server 的话，以后每个包都要带上这个连接号
+                    self._mss.max_mss = min(segment.mss_option(), Segment.MAX_MSS)
+                    self._version = segment.version  # synack 是什么格式以后就用什么格式
+                    synack = segment
+                    if not retransmitted:  # 握手也是一个 RTT 样本，重发过 syn 的不要 (Karn)
+                        self._rto.on_sample(time.monotonic() - sent_time)
+                    break
 
-            if self.flag:
-                break
+            if not self._connect_addr:
+                self._rto.on_timeout(sent_time)
+                retransmitted = True
 
-            time.sleep(0.1)
+        self.start(synack.compression)
 
         if DEBUG:
             print("Connect OK")
 
-    def recv_synack_handshake(self):
-        # receive synack
-        while True:
-            data, addr2 = self.recvfrom(4096)  # 这里收到的 synack 是 conn 发过来的，所以 addr2 一定 != addr
-            if not Segment.check_checksum(data):
-                if DEBUG:
-                    print("Received corrupted data")
-                continue
-            segment = Segment.decode(data)
-            if segment.is_synack_handshake():
-                self.set_connect_addr(addr2)
-                self.flag = True
-                break
-
     '''
     选择重传 SR
 
     本来想按 TCP 那样每个包有个 seq=xxx, ack=xxx，但是 SR 好像没必要
-    发送的时候先把 payload 分包，放在一个列表 all_segments[] 里，然后按 SR 的流程开始走
-    这时候，segment 里面 seq_num 字段就是这个 segment 在 all_segments[] 里的下标，然后如果对面正常收到，对面发过来的包的 ack_num=这个包的seq_num，
-    这样就可以很方便的用下标在发送窗口和接收窗口里面标记哪个包正常传输了
+    现在连接是一条字节流，seq_num 是这个包在整条流里的下标，从 0 开始，多次 send() 一直往后数，不会每次 send() 都从 0 开始
+    send() 的数据按 MAX_PAYLOAD_SIZE 看成一个个包，然后按 SR 的流程开始走，窗口放行到哪个包才去 memoryview 上切哪个包
+    如果对面正常收到，对面回的 ack 会确认这个包 (累计确认或者 SACK)，这样就可以很方便的用下标在发送窗口和接收窗口里面标记哪个包正常传输了
     现在已经没有什么 ack=seq+length 了，那个是 TCP 的玩法
-    '''
 
-    TIMEOUT_VALUE = 0.5 # 认为超时的阈值
-    SSTHRESH = 8  # 慢启动阈值
-    threadLock = threading.Lock()
+    连接建立之后有一个 dispatcher 线程专门收这个连接的包: ack 交给发送方，数据交给接收方，fin 回 ack
+    所以 send() 和 recv() 可以随便交替调用，对面发过来的数据不管有没有人在 recv() 都会先收下来回 ack
+    fin 只在 close() 的时候发一次，以前每次 send() 结束都要 fin 一下、每次 recv() 结束都要等 1s
+    '''
 
     def send(self, data: bytes):
         """
@@ -184,153 +282,509 @@ class RDTSocket(UnreliableSocket):
         The socket must be connected to a remote socket, i.e. self._send_to_addr must not be none.
         """
         assert self._connect_addr, "Connection not established yet. Use sendto instead."
+        if self._nodelay:
+            self.send_stream(data)
+        elif memoryview(data).nbytes < self._mss.mss:
+            self.write(data)
+        else:
+            self.flush()  # 攒着的先发，顺序不能乱
+            self.send_stream(data)
 
-        global all_segments, send_window_size, send_base, next_seq_num, temp, num_of_segments, flags, timers
-
-        # 初始化发送窗口
-        all_segments = []
-        send_window_size = 1
-        send_base = 0
-        next_seq_num = 0
-        temp = 0  # 这个变量只在拥塞控制的时候用
-
-        # 分段
-        num_of_segments = math.ceil(len(data) / Segment.MAX_PAYLOAD_SIZE)  # num_of_segments 等于 len(all_segments)
-        for i in range(num_of_segments):
-            j = i * Segment.MAX_PAYLOAD_SIZE
-            payload = data[j:j + Segment.MAX_PAYLOAD_SIZE]  # 上限超长的话 python 会自动取到最后一位就停，不会报 IndexOutOfBound
-            segment = Segment(seq_num=i, length=len(payload), payload=payload)
-            all_segments.append(segment)
-        # flags 数组用来标记包的状态: 0-还没发，1-已经收到 ack 可以不用管了，2-发了，还在等 ack
-        flags = [0] * num_of_segments  # 初始化为全 0
-        timers = [Timer() for i in range(num_of_segments)]  # 每个 segment 给一个 timer
-
-        threading.Thread(target=self.recv_ack).start() # 开一个线程收 ack
+    COALESCE_DELAY = 0.02  # 攒着的数据最多等多久
 
-        # SR
+    def write(self, data):
+        """
+        nodelay=False 的时候不满一个包长的 send() 不等 ack，放进 _writes 就返回，写线程一起发:
+        攒够一个包长、最早的数据等了 COALESCE_DELAY、或者有人 flush()/recv() 等着的时候把攒的全交给 send_stream。
+        写线程在 send_stream 里等 ack 的时候新来的都接着攒，下一次一起发，跟 Nagle 一样，一堆小 send() 也能凑成满长度的包
+        """
+        with self._writable:
+            if self._write_error is not None:
+                raise self._write_error
+            self._writes += memoryview(data).cast("B")
+            self._queued += memoryview(data).nbytes
+            if self._writer is None:
+                self._writer = threading.Thread(target=self.write_loop, daemon=True)
+                self._writer.start()
+            self._writable.notify_all()
+
+    def write_loop(self):
         while True:
-            # try:
-            if next_seq_num < num_of_segments and flags[next_seq_num] == 0 and next_seq_num < send_base + send_window_size:
-                self.sendto(all_segments[next_seq_num].encode(), self._connect_addr)
-                threading.Thread(target=self.start_timer).start() # 发包之后启动这个包的 timer
-                flags[next_seq_num] = 2
-                next_seq_num += 1
-
-            if send_base >= num_of_segments:
-                break
+            with self._writable:
+                deadline = None
+                while True:
+                    if self._writes:
+                        now = time.monotonic()
+                        deadline = deadline or now + self.COALESCE_DELAY
+                        if self._flushing or len(self._writes) >= self._mss.mss or now >= deadline:
+                            break
+                    elif self._closed:
+                        self._writer = None
+                        return
+                    self._writable.wait(deadline - now if self._writes else self.POLL_INTERVAL)
+                data, self._writes = self._writes, bytearray()
+                self._flushing = False
 
-        self.send_fin_handshake() # 发 fin，结束发送
+            try:
+                self.send_stream(data)
+            except Exception as e:  # 对面关了 (BrokenPipeError) 或者别的，记下来下一次 send()/flush() 抛，不然等着的人永远等不到
+                with self._writable:
+                    self._write_error = e
+                    self._writes.clear()
+                    self._written = self._queued
+                    self._writer = None
+                    self._writable.notify_all()
+                return
+
+            with self._writable:
+                self._written += len(data)
+                self._writable.notify_all()
+
+    def flush(self):
+        """
+        Block until everything passed to send() has been sent and acknowledged.
+        Only needed with nodelay=False, where small writes are coalesced in the background.
+        """
+        with self._writable:
+            queued = self._queued
+            self._flushing = True
+            self._writable.notify_all()
+            while self._written < queued:
+                self._writable.wait()
+            if self._write_error is not None:
+                raise self._write_error
+
+    def set_nodelay(self, nodelay: bool):
+        """像 TCP_NODELAY: True 的时候每个 send() 马上发完才返回，False 的时候小的 send() 先攒着，见 write()"""
+        self._nodelay = nodelay
+        if nodelay:
+            self.flush()
+
+    def push_writes(self):
+        """recv() 要等对面回数据了，攒着的请求别再等 COALESCE_DELAY，马上发"""
+        if self._writes:
+            with self._writable:
+                self._flushing = True
+                self._writable.notify_all()
+
+    def sendfile(self, file, offset: int = 0, count: int = None, callback=None) -> int:
+        """
+        Send a file until EOF is reached (or count bytes), return the total number of bytes which were sent.
+        file can be a path or a regular file object opened in binary mode.
+        The file is memory-mapped, segments are sliced from the mapping as the window opens,
+        so memory use does not depend on the file size.
+        With compression on, the mapping is compressed one block at a time as the window drains.
+        callback(sent, total) is called as the data gets acknowledged.
+        """
+        assert self._connect_addr, "Connection not established yet. Use sendto instead."
+        self.flush()
+
+        f = open(file, "rb") if isinstance(file, (str, os.PathLike)) else file
+        try:
+            size = os.fstat(f.fileno()).st_size
+            count = max(min(size - offset, size if count is None else count), 0)
+            if count == 0:
+                return 0
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.send_stream(memoryview(mapping)[offset:offset + count], callback)
+            finally:
+                try:
+                    mapping.close()
+                except BufferError:
+                    pass  # 重传线程手里可能还有这块的 memoryview，等它放掉之后 GC 会关
+            return count
+        finally:
+            if f is not file:
+                f.close()
+
+    def send_stream(self, data, callback=None):
+        """
+        send() 和 sendfile() 的 SR 主循环，data 所有的包都 ack 了才返回
+        callback(sent, total) 每发一个新包的时候报一下已经 ack 了多少 byte (窗口是 ack 滑开的，所以跟 ack 的进度一致)
 
-    def recv_ack(self):
-        global all_segments, send_window_size, send_base, next_seq_num, temp, num_of_segments, flags, timers
+        商量好压缩的话 data 一块一块压成帧 (见 compression.py)，前面的帧都交给 sender 了才在锁外面压下一块，
+        这时候窗口里还有包在飞，压缩和发送是叠在一起的；不压缩的时候整个 data 就是一帧，还是直接在 memoryview 上切包
+        """
+        sender = self._sender
+        total = len(memoryview(data).cast("B"))
+        frames = self._compressor.frames(data) if self._compressor else iter([(data, total)])
+        pending = None  # 压好了还没交给 sender 的帧
+        marks = collections.deque()  # 报进度用: (帧在流里从哪开始, 到哪结束, 这一帧之前用掉了多少 data, 到这一帧用掉了多少)
+        consumed = 0
+        with sender.lock:
+            if self._peer_closed:
+                raise BrokenPipeError("Connection closed by peer")
 
+        # SR
+        # 窗口满了、pacing 还没到点的时候在 sender.changed 上睡着，on_ack 滑动窗口之后会叫醒，不再空转
         while True:
-            data, addr = self.recvfrom(4096)
-
-            if not Segment.check_checksum(data):  # 如果收到的包是有错的，直接丢掉不管，反正对面已经正确接收了，大不了超时重发让对面再 ack 一次
-                if DEBUG:
-                    print("Received corrupted data")
-                continue
+            if pending is None and frames is not None:
+                pending = next(frames, None)
+                if pending is None:
+                    frames = None
+            with sender.changed:
+                seq = None
+                while seq is None:
+                    if not sender.has_unsent():
+                        if pending is not None:
+                            # 不再一上来就把整个 payload 切成 Segment 对象，窗口放行到哪个包才从 memoryview 上切哪个包
+                            if callback:
+                                marks.append((sender.total_bytes, sender.total_bytes + memoryview(pending[0]).nbytes,
+                                              consumed, pending[1]))
+                            consumed = pending[1]
+                            sender.push(pending[0])
+                            pending = None
+                            continue
+                        if frames is not None:
+                            break  # 下一块还没压，到锁外面去压
+                    if sender.idle():
+                        break
+                    if self._peer_closed:
+                        raise BrokenPipeError("Connection closed by peer")
+                    # 发送窗口再大也不能超过对面的接收窗口，不然超出去的包会被对面直接丢掉，只能等超时
+                    if not sender.has_unsent() or sender.next_seq_num >= sender.send_limit(self._cc.cwnd):
+                        sender.changed.wait()
+                        continue
+                    now = time.monotonic()
+                    if now < sender.next_send_time:
+                        sender.changed.wait(sender.next_send_time - now)
+                        continue
+                    # 先标记再发，不然 ack 可能比 flags 先到，被当成还没发的包丢掉
+                    seq = sender.new_segment()
+                    sender.send_times[seq % sender.capacity] = now  # 记下发送时间，收到 ack 的时候算 RTT
+                    parity = self.add_parity(seq, consumed == total)
+                    pacing_rate = self._cc.pacing_rate
+                    if pacing_rate:  # 按拥塞控制给的速率均匀地发，不要一下子把窗口全塞出去
+                        sender.next_send_time = max(sender.next_send_time, now - 1 / pacing_rate) + 1 / pacing_rate
+                if seq is None:
+                    if frames is None and pending is None:
+                        break
+                    continue
+
+            self._scheduler.schedule(seq, self._rto.rto, self.on_timeout)  # 给这个包定个闹钟
+            self.send_segment(seq)
+            if parity:
+                self.sendto(parity.encode(self._version), self._connect_addr)
+            if callback:
+                with sender.lock:
+                    acked = sender.offset(sender.send_base)
+                callback(self.acked_input(marks, acked), total)
+
+        if callback:
+            callback(total, total)
+        if DEBUG:
+            print("Send OK")
 
-            segment_received = Segment.decode(data)
-            if not segment_received.is_ack():
-                continue  # 收到的不是 ack，丢掉不管
-            elif flags[segment_received.ack_num] == 1:
-                continue  # 收到的 ack 是已经 ack 过的，丢掉不管
-            elif flags[segment_received.ack_num] == 0:
-                continue  # 对面nt吗 ack 了一个老子还没发的包，丢掉不管，虽然我觉得这种情况不会发生，但还是写一下吧
+    @staticmethod
+    def acked_input(marks: collections.deque, acked: int) -> int:
+        """
+        流里 ack 到了 acked，换算成 send() 的 data 用掉了多少 byte，marks 见 send_stream
+        一帧里面按比例算，不压缩的时候只有一帧，就是 ack 了多少
+        """
+        while len(marks) > 1 and marks[0][1] <= acked:
+            marks.popleft()
+        if not marks:
+            return 0
+        start, end, before, after = marks[0]
+        return before + min(max(acked - start, 0), end - start) * (after - before) // (end - start)
+
+    def add_parity(self, seq: int, last: bool) -> "Segment":
+        """
+        新包 seq 算进 FEC 的这一组，一组满了或者 send() 的数据发完了 (last 并且没有没发的包了) 返回这一组的校验包，
+        要在持有 sender.lock 的时候调
+        老格式的 header 放不下 FEC 的扩展，对面是老版本就不发
+        """
+        if self._version == Segment.LEGACY_VERSION:
+            return None
+        sender = self._sender
+        return self._fec.add(seq, sender.payload(seq), last and not sender.has_unsent(), self._conn_id)
 
-            # 以下为正常接收 ack 之后
-            flags[segment_received.ack_num] = 1
-            timers[segment_received.ack_num].closed = True  # 关闭 timer
-
-            # 发送窗口变大: 慢启动+拥塞避免
-            if send_window_size < self.SSTHRESH:
-                self.threadLock.acquire()
-                send_window_size += 1  # 指数增长阶段: 每 RTT 窗口大小*2，所以每次收到 1 个 ack，窗口大小+1
-                self.threadLock.release()
-            else:
-                temp += Fraction(1, send_window_size)
-                if temp == 1:
-                    send_window_size += 1
-                    temp = 0
-
-            # 减小 timeout 阈值
-            if self.TIMEOUT_VALUE>0.1:
-                self.TIMEOUT_VALUE-=0.1
-                if DEBUG:
-                    print("Timeout Threshold = "+str(round(self.TIMEOUT_VALUE, 1))+"s")
+    def negotiate_compression(self, peer_offer: int):
+        """
+        握手的时候按对面的 offer (老版本不带，是 None) 决定两个方向压不压，start() 里调，这时候 dispatcher 还没开始收
+        """
+        send, recv = negotiate(self._algorithm, peer_offer)
+        self._compressor = StreamCompressor(send, self._auto_compress) if send != RAW else None
+        self._receiver.decompressor = StreamDecompressor() if recv != RAW else None
 
-            while send_base < num_of_segments and flags[send_base] == 1:
-                send_base += 1  # 窗口一直滑到第一个没收到 ack 的包的位置
-            if send_base >= num_of_segments:
-                break  # send_base 已经滑出 all_segments 了，证明所有包都正确传输完毕了，可以结束了
+    def send_segment(self, seq: int):
+        data = self._sender.encode(seq, self._version, self.piggyback_ack())
+        if data is not None:  # None 是已经 ack 了，payload 可能都扔掉了，不用再发
+            self.sendto(data, self._connect_addr)
 
-    def start_timer(self):
-        global all_segments, send_window_size, send_base, next_seq_num, temp, num_of_segments, flags, timers
+    def will_send(self) -> bool:
+        """
+        发送方有还没发的包而且窗口还没满，马上就有数据包出去，对面认识的话 ack 可以捎带
+        on_data 里只是拿来估计一下，不拿 sender.lock
+        """
+        if self._version < Segment.PIGGYBACK_VERSION:
+            return False
+        sender = self._sender
+        return sender.has_unsent() and sender.next_seq_num < sender.send_limit(self._cc.cwnd)
 
-        if next_seq_num >= num_of_segments:
-            return
+    def piggyback_ack(self) -> tuple:
+        """
+        数据包要捎带的 (累计确认, 接收窗口)，对面不认识 (版本 2 以前) 就是 None
+        按顺序收到、还在等延迟 ack 的包这一下就确认了，闹钟取消掉，echo 这种两个方向都有数据的基本不用再单独回 ack
+        窗口里有乱序的包的时候 on_data 已经马上回过带 SACK 位图的 ack 了，这里不带位图，
+        接收窗口的扩展是 4 byte，加上 15 byte 的 header 和 1 byte 的 OPT_END 一共 20 byte，还比老格式的 21 byte 短，包不会变长
+        """
+        if self._version < Segment.PIGGYBACK_VERSION:
+            return None
+        receiver = self._receiver
+        with receiver.lock:
+            settled = receiver.unacked and not receiver.has_gap()
+            if settled:
+                receiver.unacked = 0
+            ack = receiver.recv_base, receiver.advertise()
+        if settled:
+            self._scheduler.cancel("ack")
+        return ack
+
+    def probe_window(self, key=None):
+        """
+        对面的接收窗口关了而且没有在飞的包的时候，每隔一个 RTO 发一个窗口探测，对面 recv() 拿走数据之后主动发的 ack 丢了也不会卡死
+        探测是一个空的数据包，seq_num 是对面已经收过的，对面不会收下它，只会马上回一个带窗口的 ack
+        也是 "probe" 闹钟的回调，key 用不到
+        """
+        sender = self._sender
+        with sender.lock:
+            if not sender.window_closed() or sender.send_base == 0:
+                return
+            probe = Segment(seq_num=sender.send_base - 1, payload=b"", conn_id=self._conn_id)
+        self._scheduler.schedule("probe", self._rto.rto, self.probe_window)
+        self.sendto(probe.encode(self._version), self._connect_addr)
+
+    def recvfile(self, file, count: int = None, callback=None, bufsize: int = 1 << 16) -> int:
+        """
+        Receive into a file until the peer closes the connection (or count bytes), return the number of bytes written.
+        file can be a path or a file object opened in binary mode.
+        Data is written as it arrives in order through one reusable buffer of bufsize bytes,
+        so memory use does not depend on the file size.
+        callback(received, count) is called after every write, count may be None.
+        """
+        f = open(file, "wb") if isinstance(file, (str, os.PathLike)) else file
+        try:
+            buffer = memoryview(bytearray(bufsize))
+            received = 0
+            while count is None or received < count:
+                n = self.recv_into(buffer, bufsize if count is None else min(bufsize, count - received))
+                if not n:
+                    break
+                f.write(buffer[:n])
+                received += n
+                if callback:
+                    callback(received, count)
+            return received
+        finally:
+            if f is not file:
+                f.close()
+
+    DUPACK_THRESHOLD = 3  # 后面有几个包被确认了就认为前面没确认的丢了
+
+    def start(self, peer_offer: int = None):
+        """
+        连接建立了，开 dispatcher 线程收这个连接的所有包
+        peer_offer 是对面握手带的压缩 offer，解压器要在 dispatcher 收到第一个数据包之前装好，不然压缩的帧会原样交给 recv()
+        """
+        self._sender = SenderState(conn_id=self._conn_id)
+        self._receiver = ReceiverState()
+        self.negotiate_compression(peer_offer)
+        self.settimeout(self.POLL_INTERVAL)
+        threading.Thread(target=self.dispatch, daemon=True).start()
 
-        timer_index = next_seq_num # timer 的下标
+    POLL_INTERVAL = 0.5  # dispatcher 隔多久看一眼连接是不是关了
+    RECV_BUFFER_SIZE = 8192  # 比最大的包大就行，network.py 转发的时候前面还有 8 byte 地址
 
-        while True:
-            if timers[timer_index].closed:
-                if DEBUG:
-                    print("Timer " + str(timer_index) + " closed")
-                break
+    def dispatch(self):
+        while not self._closed:
             try:
-                timers[timer_index].start(self.TIMEOUT_VALUE)
-                if DEBUG:
-                    print("Timer " + str(timer_index) + " started")
-            except TimeoutException:
-                resend_index = timer_index  # 这个下标就是我要重传的包的下标
-                if DEBUG:
-                    print("Segment " + str(resend_index) + " timeout")
-                self.sendto(all_segments[resend_index].encode(), self._connect_addr)  # 重发这个包
-                # 拥塞控制，发送窗口大小=1，重设阈值
-                self.SSTHRESH = send_window_size / 2
-                self.threadLock.acquire()
-                send_window_size = 1
-                self.threadLock.release()
-
-                # 增大 timeout 阈值
-                self.TIMEOUT_VALUE+=0.2
-                if DEBUG:
-                    print("Timeout Threshold = "+str(round(self.TIMEOUT_VALUE, 1))+"s")
-
-    def send_fin_handshake(self):
-        self.flag = False
-        threading.Thread(target=self.recv_ack_handshake_after_send_fin_handshake).start()
-
-        while True:
-            # send fin
-            self.sendto(Segment.fin_handshake().encode(), self._connect_addr)
-
-            if self.flag:
-                break
-
-            time.sleep(0.1)
-
-        if DEBUG:
-            print("Send OK")
+                data, addr = self.recvfrom(self.RECV_BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                break  # socket 已经关了
 
-    def recv_ack_handshake_after_send_fin_handshake(self):
-        # receive ack
-        while True:
-            data, addr = self.recvfrom(4096)
             if addr != self._connect_addr:
                 if DEBUG:
                     print("A stranger is sending data to me")
                 continue
-            if not Segment.check_checksum(data):
+
+            # checksum 不对，或者 header 不完整 (比 header 短、扩展坏了)，直接丢弃，等对面超时重发
+            segment = Segment.decode(data) if Segment.check_checksum(data) else None
+            if segment is None:
                 if DEBUG:
                     print("Received corrupted data")
                 continue
-            segment = Segment.decode(data)
-            if segment.is_ack_handshake():
-                self.flag = True
-                break
+
+            # 一个包处理出错只丢这个包，dispatcher 退出了连接就卡死了
+            try:
+                self.handle_segment(segment)
+            except Exception as e:
+                if DEBUG:
+                    print("Dropped malformed segment: " + repr(e))
+
+    def handle_segment(self, segment: "Segment"):
+        """
+        连接收到的一个包 (已经检查过地址和 checksum)，自己的 dispatcher 或者 MultiplexEngine 调这个
+        """
+        if segment.is_ack():
+            self.on_ack(segment)
+        elif segment.is_data():
+            if segment.ack:  # 捎带的 ack 先处理，窗口早点滑开
+                self.on_ack(segment)
+            self.on_data(segment)
+        elif segment.is_parity():
+            self.on_parity(segment)
+        elif segment.is_fin_handshake():
+            self.on_fin(segment)
+        elif segment.is_ack_handshake():
+            self._fin_acked.set()  # 对面确认了我们 close() 发的 fin
+        elif segment.is_mss_probe():
+            self.sendto(Segment.mss_probe_ack(segment.seq_num, conn_id=self._conn_id).encode(self._version),
+                        self._connect_addr)
+        elif segment.is_mss_probe_ack():
+            self.on_mss_probe_ack(segment)
+
+    def on_ack(self, segment_received: "Segment"):
+        sender = self._sender
+        with sender.lock:
+            if segment_received.window is not None:  # 对面通告的接收窗口，窗口开了要叫醒 send()
+                sender.window_end = segment_received.ack_num + segment_received.window
+                sender.changed.notify_all()
+                self.watch_window(sender)
+            # 累计确认: ack_num 之前的全收到了；SACK 位图: 窗口里后面零散收到的
+            # 只处理还在等 ack 的，已经 ack 过的、还没发的 (对面nt吗) 都不管
+            cumulative_ack = min(segment_received.ack_num, sender.next_seq_num)
+            newly_acked = [seq for seq in range(sender.send_base, cumulative_ack) if sender.in_flight(seq)]
+            newly_acked.extend(seq for seq in segment_received.sacked() if sender.in_flight(seq))
+            if not newly_acked:
+                return
+
+            # 以下为正常接收 ack 之后
+            now = time.monotonic()
+            sample_time = None
+            for seq in newly_acked:
+                slot = seq % sender.capacity
+                sender.flags[slot] = 1
+                self._scheduler.cancel(seq)  # 取消这个包的闹钟
+                # Karn: 重传过的包不知道 ack 是回给哪一次发送的，这种 RTT 样本不要
+                if not sender.retransmitted[slot] and (sample_time is None or sender.send_times[slot] > sample_time):
+                    sample_time = sender.send_times[slot]
+
+            # 一个 ack 只采一个样本，用确认的包里最后发出去的那个，这样延迟 ack 也不会被重复算好几次
+            if sample_time is not None:
+                self._rto.on_sample(now - sample_time)
+                self._cc.on_rtt_sample(now - sample_time)
+            self._cc.on_ack(len(newly_acked), now)  # 一个 ack 确认了几个包就算几个
+
+            sender.slide()  # 窗口一直滑到第一个没收到 ack 的包的位置
+            self.watch_window(sender)
+            resend = self.detect_losses(sender)
+            probe = self._mss.on_ack(len(newly_acked), sender)
+            sender.changed.notify_all()  # 窗口滑了、cwnd 变了，叫醒 send()
+
+        # 快速重传，不用等闹钟响
+        for seq in resend:
+            if DEBUG:
+                print("Segment " + str(seq) + " fast retransmit")
+            self._scheduler.schedule(seq, self._rto.rto, self.on_timeout)
+            self.send_segment(seq)
+        if probe:
+            self.send_mss_probe()
+
+    def send_mss_probe(self, key=None):
+        """
+        发一个包长探测包，一个 RTO 没回就再发 (MSSProber.MAX_PROBES 次)
+        也是 "mss" 闹钟的回调，key 用不到
+        """
+        with self._sender.lock:
+            if key is not None and not self._mss.on_probe_lost():
+                return
+            probe = self._mss.probe(self._conn_id, self._version)
+        self._scheduler.schedule("mss", self._rto.rto, self.send_mss_probe)
+        self.sendto(probe.encode(self._version), self._connect_addr)
+
+    def on_mss_probe_ack(self, segment_received: "Segment"):
+        """探测包过了，之后的新包按新的包长切"""
+        sender = self._sender
+        with sender.lock:
+            if not self._mss.on_probe_ack(segment_received.seq_num):
+                return
+            sender.set_mss(self._mss.mss)
+        self._scheduler.cancel("mss")
+
+    def watch_window(self, sender: "SenderState"):
+        """对面的接收窗口关了而且没有在飞的包的话定个闹钟发窗口探测，开了就取消，要在持有 sender.lock 的时候调"""
+        if sender.window_closed():
+            self._scheduler.schedule("probe", self._rto.rto, self.probe_window)
+        else:
+            self._scheduler.cancel("probe")
+
+    def detect_losses(self, sender: "SenderState") -> list:
+        """
+        快速重传: 一个还在等 ack 的包，如果比它后发的包已经有 DUPACK_THRESHOLD 个被确认了，基本可以认定它丢了，马上重传，不用等超时
+        快速恢复: 这时候通知拥塞控制 (reno 是窗口减半，不像超时那样降到 1)，一个窗口里丢了好几个也只通知一次 (直到 send_base 越过 recovery_point)
+        要在持有 sender.lock 的时候调用，返回要重传的包
+        """
+        resend = []
+        acked_above = 0  # 比 seq 后发、已经确认了的包数
+        # 在发校验包的话，丢的包等这一组的校验包到了对面自己就补出来了，多等一组再算丢；
+        # 但窗口小的时候后面根本没有那么多包，多等的不能超过窗口里多出来的 (还要给再丢几个留余地)，不然只能等超时
+        in_flight = sender.next_seq_num - sender.send_base
+        threshold = self.DUPACK_THRESHOLD + min(self._fec.k or 0, max(0, in_flight - 2 * self.DUPACK_THRESHOLD))
+        for seq in range(sender.next_seq_num - 1, sender.send_base - 1, -1):
+            slot = seq % sender.capacity
+            if sender.flags[slot] == 1:
+                acked_above += 1
+            elif acked_above >= threshold and not sender.fast_retransmitted[slot]:
+                resend.append(seq)
+        if not resend:
+            return resend
+
+        now = time.monotonic()
+        if sender.send_base >= sender.recovery_point:
+            self._cc.on_loss(False, now)
+            sender.recovery_point = sender.next_seq_num
+
+        for seq in resend:
+            self._fec.on_loss()
+            slot = seq % sender.capacity
+            sender.fast_retransmitted[slot] = True  # 每个包只快速重传一次，再丢就只能等超时了
+            sender.retransmitted[slot] = True
+            sender.send_times[slot] = now
+        return resend
+
+    def on_timeout(self, resend_index):
+        """
+        scheduler 线程在某个包超时的时候回调这个函数，resend_index 就是要重传的包的 seq_num
+        """
+        sender = self._sender
+
+        with sender.lock:
+            if not sender.in_flight(resend_index):
+                return  # 已经 ack 过了，不管
+
+            if DEBUG:
+                print("Segment " + str(resend_index) + " timeout")
+            slot = resend_index % sender.capacity
+            now = time.monotonic()
+            # 拥塞控制 (reno 是窗口降到 1)，一次丢一串的时候会一起超时，同一批发出去的包只通知一次
+            if sender.send_times[slot] >= sender.loss_time:
+                self._cc.on_loss(True, now)
+                sender.loss_time = now
+
+            # 超时了说明 RTO 估小了，指数退避，直到收到一个没重传过的包的 ack 再按 RTT 重新算
+            self._fec.on_loss()
+            sender.retransmitted[slot] = True
+            self._rto.on_timeout(sender.send_times[slot])
+            sender.send_times[slot] = now
+            if DEBUG:
+                print("Timeout Threshold = " + str(round(self._rto.rto, 3)) + "s")
+
+        self._scheduler.schedule(resend_index, self._rto.rto, self.on_timeout)  # 重新定闹钟
+        self.send_segment(resend_index)  # 重发这个包
 
     def recv(self, bufsize) -> bytes:
         """
@@ -344,109 +798,754 @@ class RDTSocket(UnreliableSocket):
         """
         assert self._connect_addr, "Connection not established yet. Use recvfrom instead."
 
-        # 初始化接收窗口
-        recv_window_size = 8  # 这个 size 好像没啥用
-        recv_base = 0
+        # 跟 TCP 一样，有多少按顺序收到的数据就先返回多少 (最多 bufsize)，一点都没有就等着
+        # 对面 close() 了而且数据都读完了就返回 b''
+        receiver = self._receiver
+        self.push_writes()
+        with receiver.readable:
+            while not receiver.ready and not receiver.eof:
+                receiver.readable.wait()
+            data = b"".join(receiver.take(bufsize))  # 收到的包到这里才拷一次
+            if not data and receiver.error is not None:
+                raise receiver.error
+            reopened = receiver.reopened()
+        if reopened:
+            self.send_data_ack()  # 通告过窗口 0，现在又能收了，马上告诉对面
+        return data
+
+    def recv_into(self, buffer, nbytes: int = 0) -> int:
+        """
+        Receive up to nbytes bytes from the socket, storing the data into a buffer
+        (bytearray, memoryview, ...) rather than creating a new bytestring.
+        If nbytes is not specified (or 0), receive up to the size available in the given buffer.
+        Returns the number of bytes received, 0 after the peer closed the connection.
+        """
+        nbytes, ancdata, flags, address = self.recvmsg_into([memoryview(buffer).cast("B")[:nbytes or None]])
+        return nbytes
 
-        # 不知道对面一共要发几个包，接收窗口只能设成最大长度了
-        max_num_of_received_segments = math.ceil(bufsize / Segment.MAX_PAYLOAD_SIZE)  # ceil 还是 floor?
-        recv_window = [None] * max_num_of_received_segments
+    def recvmsg_into(self, buffers) -> (int, list, int, (str, int)):
+        """
+        Like recv_into, but scatters the data into a sequence of buffers, filling each before moving on to the next.
+        Returns (nbytes, ancdata, msg_flags, address) like socket.recvmsg_into, ancdata is always empty.
+        """
+        assert self._connect_addr, "Connection not established yet. Use recvfrom instead."
 
-        # 接收窗口收到了连续的包之后，就 extend 到 all_payloads，最后接收完了之后 return bytes(all_received_payloads)，这就是发送方发的所有有效载荷
-        all_received_payloads = bytearray()
+        # payload 从收到的包里直接拷进调用者的 buffer，中间不再攒一份 bytearray
+        receiver = self._receiver
+        nbytes = 0
+        self.push_writes()
+        with receiver.readable:
+            while not receiver.ready and not receiver.eof:
+                receiver.readable.wait()
+            for buffer in buffers:
+                nbytes += receiver.read_into(memoryview(buffer).cast("B"))
+            if not nbytes and receiver.error is not None:
+                raise receiver.error
+            reopened = receiver.reopened()
+        if reopened:
+            self.send_data_ack()
+        return nbytes, [], 0, self._connect_addr
+
+    def on_data(self, segment_received: "Segment"):
+        receiver = self._receiver
+        with receiver.lock:
+            seq = segment_received.seq_num
+            in_order = seq == receiver.recv_base
+            if not receiver.accepts(seq):
+                in_order = False  # 超出接收窗口了，丢弃，马上回 ack，发送方好知道窗口到哪
+            elif seq >= receiver.recv_base:
+                receiver.put(seq, segment_received.payload)  # 以下为正确接收
+            # 按顺序来的包攒够 ACK_EVERY 个再回，或者等 DELAYED_ACK_TIMEOUT 之后一起回
+            # 自己马上就有数据包要发的话多攒一倍，让数据包捎带回去 (见 piggyback_ack)
+            # 乱序的、重复的包马上回，让发送方赶紧知道缺了哪个
+            receiver.unacked += 1
+            ack_every = receiver.ACK_EVERY * (2 if self.will_send() else 1)
+            ack_now = not in_order or receiver.unacked >= ack_every or receiver.has_gap()
+
+            if receiver.parities:
+                ack_now = receiver.repair(seq) or ack_now
+
+        if ack_now:
+            self._scheduler.cancel("ack")
+            self.send_data_ack()
+        else:
+            self._scheduler.schedule("ack", receiver.DELAYED_ACK_TIMEOUT, self.send_data_ack)
+
+    def on_parity(self, segment_received: "Segment"):
+        """
+        FEC 的校验包: 这一组只缺一个包的话马上补出来回 ack，缺得多就先留着，等重传的包到了再补
+        """
+        receiver = self._receiver
+        with receiver.lock:
+            if not receiver.add_parity(segment_received):
+                return
+        if DEBUG:
+            print("Segment repaired by parity")
+        self._scheduler.cancel("ack")
+        self.send_data_ack()
 
-        while True:
-            # 只收来自 _connect_addr 的消息  
-            data, addr = self.recvfrom(bufsize)
-            if addr != self._connect_addr:
-                if DEBUG:
-                    print("A stranger is sending data to me")
-                continue
+    def send_data_ack(self, key=None):
+        """
+        回一个 ack: ack_num 是累计确认 (recv_base 之前的全收到了)，payload 是接收窗口的 SACK 位图
+        也是延迟 ack 的闹钟回调，key 用不到
+        """
+        receiver = self._receiver
+        with receiver.lock:
+            receiver.unacked = 0
+            segment = Segment.data_ack(receiver.recv_base, receiver.sack_bitmap(), conn_id=self._conn_id,
+                                       window=receiver.advertise())
+        self.sendto(segment.encode(self._version), self._connect_addr)
+
+    def on_fin(self, segment_received: "Segment"):
+        """
+        对面 close() 了: 回 ack，告诉 recv() 没有更多数据了
+        ack 可能丢，对面会重发 fin，所以 close() 之前 dispatcher 一直在这里回，close() 之后交给 TIME_WAIT_REAPER
+        fin 的 ack_num 也是累计确认，对面最后一个延迟 ack 还没回就 close() 的话，靠它把我们发的最后几个包确认掉
+        """
+        self.on_ack(segment_received)
+        self._scheduler.cancel("ack")
+        self.send_data_ack()  # 还欠着的 ack 先回掉
+        self.sendto(Segment.ack_handshake(conn_id=self._conn_id).encode(self._version), self._connect_addr)
+
+        receiver = self._receiver
+        with receiver.readable:
+            if not receiver.eof and DEBUG:
+                print("Receive OK")
+            receiver.eof = True
+            receiver.readable.notify_all()
+        with self._sender.changed:
+            self._peer_closed = True
+            self._sender.changed.notify_all()
+
+    FIN_RETRIES = 10  # fin 最多发几次，对面一直不回就不管了
+    TIME_WAIT = 1  # 对面先 close() 的时候，我们回的 ack 可能丢，后台再留这么久回重发的 fin，可以按 socket 改
 
-            if not Segment.check_checksum(data):  # 收到坏包，直接丢弃，等对面超时重发
-                if DEBUG:
-                    print("Received corrupted data")
-                continue
+    def close(self):
+        """
+        Finish the connection and release resources. For simplicity, assume that
+        after a socket is closed, neither futher sends nor receives are allowed.
+        """
+        if self._mux is not None:
+            self._mux.close()  # 多路复用的 server: 不再接受新连接，端口等最后一个连接关了 engine 再关
+            return
+        self.finish()
+        self._closed = True
+        self._scheduler.close()
+        if self._listener is not None:
+            self._listener.forget(self)
+        if self._connect_addr and self._peer_closed:
+            # 对面先关: 我们回的 ack 可能丢，socket 交给后台的 TIME_WAIT_REAPER 再回一会儿重发的 fin，close() 直接返回
+            TIME_WAIT_REAPER.add(self)
+        else:
+            super().close()
+
+    def finish(self):
+        """
+        close() 的前半段: 我们先关的话发 fin，等对面的 ack，超时就重发
+        fin 顺便带上累计确认，还欠着的延迟 ack 就不用单独回了
+        """
+        if self._writer is not None:
+            try:
+                self.flush()  # 攒着的先发完
+            except Exception:
+                pass  # 对面已经关了、或者写线程出错了，发不出去了，close() 还是要关干净
+        if self._connect_addr and not self._closed and not self._peer_closed:
+            self._scheduler.cancel("ack")
+            fin = Segment.fin_handshake(ack_num=self._receiver.recv_base, conn_id=self._conn_id).encode(self._version)
+            for _ in range(self.FIN_RETRIES):
+                self.sendto(fin, self._connect_addr)
+                if self._fin_acked.wait(self._rto.rto):
+                    break
 
-            segment_received = Segment.decode(data)
+    def set_connect_addr(self, addr):
+        self._connect_addr = addr
 
-            if segment_received.is_fin_handshake():
-                self.send_ack_handshake()  # 收到 fin，回 ack, 一段时间后停止接收
-                break
-            elif segment_received.seq_num < recv_base:
-                self.sendto(Segment(ack_num=segment_received.seq_num).encode(), self._connect_addr)  # 收到了已经交付的包，回个 ack
-                continue
-            elif segment_received.seq_num >= recv_base + recv_window_size:
-                continue  # 超出接收窗口了，丢弃
+    def set_congestion_control(self, congestion):
+        """
+        换拥塞控制算法，congestion 可以是 "reno", "cubic", "bbr"，或者 congestion.CongestionController 的子类/实例
+        """
+        self._cc = create_congestion_controller(congestion)
+
+    @property
+    def congestion_control(self):
+        """当前连接的拥塞控制，可以看 cwnd, pacing_rate"""
+        return self._cc
+
+    @property
+    def rto(self) -> float:
+        """当前的超时重传阈值 (秒)"""
+        return self._rto.rto
+
+    @property
+    def fec(self) -> "FECController":
+        """FEC 的状态，k 是现在几个数据包跟一个校验包，None 表示现在没发校验包"""
+        return self._fec
+
+    @property
+    def mss(self) -> int:
+        """现在新发的包的 payload 最长多少 byte"""
+        return self._mss.mss
+
+    @property
+    def srtt(self) -> float:
+        """平滑后的 RTT (秒)，还没有样本的时候是 None"""
+        return self._rto.srtt
+
+    @property
+    def rttvar(self) -> float:
+        """RTT 的平均偏差 (秒)，还没有样本的时候是 None"""
+        return self._rto.rttvar
+
+
+HEADER = struct.Struct("!H???IIII")  # 老格式的 header，提前编译好，不用每个包都重新解析一遍格式字符串
+COMPACT_HEADER = struct.Struct("!HBIII")  # 新格式: checksum, flags, seq_num, ack_num, conn_id
+CHECKSUM = struct.Struct("!H")
+OPTION = struct.Struct("!BB")  # 新格式 header 后面的扩展 (TLV): type, length，后面跟 length byte 的值
+MSS_OPTION = struct.Struct("!H")  # 这一端最多能收多长的 payload
+HANDSHAKE_OPTION = struct.Struct("!HBB")  # 老格式 syn/synack 的 payload: MSS, 认识的最高 header 版本, 压缩 (见 compression.py)
+FEC_OPTION = struct.Struct("!BH")  # 校验包: 这一组几个包，这几个包长度的 XOR
+WINDOW_OPTION = struct.Struct("!H")  # ack: 接收方从 ack_num 开始还能收几个包
+
+
+def ones_complement_sum(data) -> int:
+    """
+    16 bit 反码求和，和以前 zip(i, i) 一对一对加起来结果一样，但是快很多
 
-            # 以下为正确接收
-            self.sendto(Segment(ack_num=segment_received.seq_num).encode(), self._connect_addr)
+    把整个字节流当成一个大端的大整数，因为 2^16 = 1 (mod 0xFFFF)，
+    所以每 16 bit 一组加起来再把进位加回去，其实就是这个大整数 mod 0xFFFF，全在 C 里算完
+    唯一的区别是反码里 0xFFFF 和 0 是同一个数，mod 出来是 0 的时候要换回 0xFFFF (全 0 的情况除外)
+    """
+    n = int.from_bytes(data, "big")
+    if len(data) % 2 == 1:  # pad zeros to form a 16-bit word for checksum
+        n <<= 8
+    bytes_sum = n % 0xFFFF
+    if bytes_sum == 0 and n:
+        bytes_sum = 0xFFFF
+    return bytes_sum
 
-            if segment_received.seq_num >= len(recv_window) - 1:
-                temp = [None] * math.ceil(bufsize / Segment.MAX_PAYLOAD_SIZE)
-                recv_window += temp
-                max_num_of_received_segments += math.ceil(bufsize / Segment.MAX_PAYLOAD_SIZE)
 
-            recv_window[segment_received.seq_num] = segment_received
-            while recv_base < max_num_of_received_segments and recv_window[recv_base]: # 交付数据，滑动窗口
-                all_received_payloads.extend(recv_window[recv_base].payload)
-                recv_base += 1
+class RTOEstimator:
+    """
+    按 Jacobson/Karels 的方法从 RTT 样本算超时阈值 (RFC 6298)
 
-        return bytes(all_received_payloads)
+        第一个样本:  SRTT = R, RTTVAR = R/2
+        之后:       RTTVAR = (1-BETA)*RTTVAR + BETA*|SRTT-R|
+                    SRTT = (1-ALPHA)*SRTT + ALPHA*R
+        RTO = SRTT + K*RTTVAR，再夹在 [min_rto, max_rto] 之间
 
-    def send_ack_handshake(self):
-        self.setblocking(False)
-        flag = True
-        while True:
-            if flag:
-                start_time = time.time()
-                flag = False
-            end_time = time.time()
-            if end_time - start_time > 1:  # 等待这个时间之后就结束
-                self.setblocking(True)
-                break
+    超时的时候 RTO 翻倍 (指数退避)，直到下一个有效样本进来才重新按公式算
+    SR 每个包一个闹钟，一次丢一串的时候会一起超时，同一批发出去的包超时只退避一次，不然一下就翻到 max_rto 了
+    哪些样本有效 (Karn 算法，不要重传过的包的样本) 由调用的人判断
+    """
 
-            # receive fin
-            try:
-                data, addr = self.recvfrom(4096)
-            except BlockingIOError:
-                continue
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_rto=0.5, min_rto=0.1, max_rto=10.0):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self._rto = initial_rto
+        self._backoff_time = 0.0  # 上一次退避的时间，在这之前发出去的包超时就不再退避了
+
+    @property
+    def rto(self) -> float:
+        return min(max(self._rto, self.min_rto), self.max_rto)
+
+    def on_sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self._rto = self.srtt + self.K * self.rttvar
+
+    def on_timeout(self, sent_time: float):
+        """sent_time 是超时的那个包上一次发出去的时间"""
+        if sent_time < self._backoff_time:
+            return
+        self._rto = min(self.rto * 2, self.max_rto)
+        self._backoff_time = time.monotonic()
 
-            if not flag:
-                flag = True
 
-            if addr != self._connect_addr:
-                if DEBUG:
-                    print("A stranger is sending data to me")
-                continue
+class MSSProber:
+    """
+    发送方新包的包长 (MSS)，像 PLPMTUD (RFC 8899) 那样从肯定能过的 MAX_PAYLOAD_SIZE 开始往上试:
 
-            if not Segment.check_checksum(data):
-                if DEBUG:
-                    print("Received corrupted data")
-                continue
+        当前包长连续确认了 probe_after 个包就试下一档 (翻倍，不超过握手商量的 max_mss)
+        探测包只有填充，不带数据，也不占 seq_num，对面收到就回一个探测包的 ack，回来了这一档就算过了，之后的新包才按这个长度切
+        一个 RTO 没回就再发，连着 MAX_PROBES 个都丢了就不试了，probe_after 翻倍，大包在这条路上过不去的话就不会一直试
 
-            segment = Segment.decode(data)
+    数据只按确认能过的包长切，探测丢了数据也不受影响 (SR 的 seq_num 是包的下标，已经发出去的包重传的时候长度不能变)
+    要在持有 sender.lock 的时候调用
+    """
 
-            # then send ack
-            if segment.is_fin_handshake():
-                self.sendto(Segment.ack_handshake().encode(), self._connect_addr)
+    PROBE_AFTER = 32
+    MAX_PROBE_AFTER = 1024
+    MAX_PROBES = 3  # RFC 8899 的 MAX_PROBES，network.py 本来就随机丢包，丢一个不能说明大包过不去
+
+    def __init__(self, max_mss: int = None):
+        self.max_mss = max_mss or Segment.MAX_PAYLOAD_SIZE  # 握手的时候改成商量好的
+        self.mss = Segment.MAX_PAYLOAD_SIZE  # 确认能过的包长，新的数据按这个切
+        self.probe_size = None  # 在试的包长，None 表示没有在试
+        self.probe_id = 0  # 探测包的编号，放在 seq_num 里，对面的 ack 原样带回来
+        self.probes = 0  # 这一档发了几个探测包
+        self.probe_after = self.PROBE_AFTER
+        self.acked = 0  # 这一档连续确认了几个包
+
+    def on_ack(self, acked: int, sender: "SenderState") -> bool:
+        """确认了 acked 个数据包，返回要不要开始试下一档 (要的话调用的人发探测包)"""
+        if self.probe_size is not None:
+            return False
+        self.acked += acked
+        if self.acked >= self.probe_after and self.mss < self.max_mss and sender.has_unsent():
+            self.probe_size = min(self.mss * 2, self.max_mss)
+            self.probe_id = (self.probe_id + 1) % Segment.MAX_NUM
+            self.probes = 0
+            self.acked = 0
+            return True
+        return False
+
+    def on_probe_ack(self, probe_id: int) -> bool:
+        """探测包的 ack 回来了，返回包长是不是变了"""
+        if self.probe_size is None or probe_id != self.probe_id:
+            return False  # 早就不试了、或者是上一档的
+        self.mss = self.probe_size
+        self.probe_size = None
+        self.probe_after = self.PROBE_AFTER
+        return True
+
+    def on_probe_lost(self) -> bool:
+        """探测包一个 RTO 没回，返回要不要再发一个"""
+        if self.probe_size is None:
+            return False
+        if self.probes < self.MAX_PROBES:
+            return True
+        self.probe_size = None
+        self.probe_after = min(self.probe_after * 2, self.MAX_PROBE_AFTER)
+        return False
+
+    def probe(self, conn_id: int, version: int) -> "Segment":
+        """正在试的那一档的探测包，编码出来跟这个包长最长的包 (老格式 header 的数据包、带扩展的校验包) 一样长"""
+        self.probes += 1
+        header_size = Segment.HEADER_SIZE if version == Segment.LEGACY_VERSION else Segment.COMPACT_HEADER_SIZE
+        return Segment.mss_probe(self.probe_id, bytes(self.probe_size + Segment.HEADER_SIZE - header_size), conn_id)
+
+
+def xor_payloads(payloads, size: int) -> int:
+    """
+    一串 payload 的 XOR，短的后面补 0 到 size 那么长，结果是个大整数 (to_bytes(size) 就是字节)
+    跟 checksum 一样当成大整数在 C 里算，不一个 byte 一个 byte 地异或
+    """
+    result = 0
+    for payload in payloads:
+        result ^= int.from_bytes(payload, "big") << 8 * (size - len(payload))
+    return result
 
-        if DEBUG:
-            print("Receive OK")
 
-    def close(self):
+class FECController:
+    """
+    发送方的 FEC (前向纠错): 每 k 个新数据包后面跟一个校验包，payload 是这 k 个包 payload 的 XOR (短的补 0)，
+    扩展里带着 k 和这 k 个包长度的 XOR，对面这一组里丢了 (或者坏了) 任意一个都能用另外 k-1 个和校验包补出来，
+    不用等快速重传，更不用等超时。send() 的数据发完了一组还没满也马上发，尾巴上丢的包最容易只能等超时
+
+    k 按丢包率调: 每发 EVAL_PERIOD 个新包看一次这段时间里还要重传的包 (校验包没补回来的) 占多少，
+    超过 TARGET_LOSS 就把 k 减半 (多发校验包)，不到四分之一就翻倍，到了 MAX_GROUP 还翻就是不发了 (k=None)，
+    所以链路不丢包的时候一个校验包都没有。校验包不占窗口、不重传、对面也不单独回 ack
+    拥塞控制看不见校验包，所以 RDTSocket 默认不开 (fec=False)
+    """
+
+    MIN_GROUP = 2
+    MAX_GROUP = 16
+    EVAL_PERIOD = 32
+    TARGET_LOSS = 0.01
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.k = None  # 现在几个数据包一个校验包，None 是不发
+        self.sent = 0  # 这一段发了几个新包
+        self.lost = 0  # 这一段重传了几次
+        self.first = None  # 这一组第一个包的 seq_num
+        self.payloads = []
+
+    def on_loss(self):
+        self.lost += 1
+
+    def add(self, seq_num: int, payload, flush: bool, conn_id: int = 0) -> "Segment":
+        """新发了第 seq_num 个包，这一组满了 (或者 flush) 返回校验包，要在持有 sender.lock 的时候调"""
+        self.sent += 1
+        if self.sent >= self.EVAL_PERIOD:
+            self.adapt()
+        if self.k is None:
+            return None
+
+        if not self.payloads:
+            self.first = seq_num
+        self.payloads.append(payload)
+        if len(self.payloads) < self.k and not flush:
+            return None
+
+        size = max(len(payload) for payload in self.payloads)
+        parity = xor_payloads(self.payloads, size).to_bytes(size, "big")
+        length = 0
+        for payload in self.payloads:
+            length ^= len(payload)
+        segment = Segment(seq_num=self.first, payload=parity, conn_id=conn_id, fec=(len(self.payloads), length))
+        self.payloads = []
+        return segment
+
+    def adapt(self):
+        loss_rate = self.lost / self.sent
+        self.sent = self.lost = 0
+        if not self.enabled:
+            return
+        if loss_rate > self.TARGET_LOSS:
+            self.k = self.MAX_GROUP if self.k is None else max(self.k // 2, self.MIN_GROUP)
+        elif loss_rate < self.TARGET_LOSS / 4 and self.k is not None:
+            self.k = None if self.k >= self.MAX_GROUP else self.k * 2
+        if self.k is None:
+            self.payloads = []
+
+
+class SenderState:
+    """
+    一个连接的 SR 发送状态，以前是 module 里的 global 变量，所有 RDTSocket 共用，
+    两个 conn 同时 send() 就会互相踩，现在每个连接自己一份，自己一把锁
+
+    连接是一条字节流，seq_num 跨 send() 一直往后数，每次 send() 的数据作为一块 (chunk) 接在后面，
+    一个包不会跨两块 (凑包是以后的事)。每块只保存一个 memoryview 和这块按多长切包，要发的时候才切出对应的包 (不拷贝)，
+    然后直接编码进这个线程自己的发送缓冲区，已经全部 ack 的块就扔掉，所以内存只跟窗口有关
+
+    窗口不会超过 capacity，所以每个包的状态放在 seq % capacity 的槽里，窗口滑过去就清掉
+    flags 数组用来标记包的状态: 0-还没发，1-已经收到 ack 可以不用管了，2-发了，还在等 ack
+    每个槽的状态都是 bytearray/array 里的一格 (一个包 1 byte 的标记加 8 byte 的发送时间)，不是 list 里的 Python 对象，
+    传多大的文件都不会多出对象来，GC 也不用扫
+    """
+
+    def __init__(self, capacity: int = None, conn_id: int = 0):
+        self.conn_id = conn_id
+        self.capacity = capacity or ReceiverState.RECV_WINDOW_SIZE
+        self.chunks = collections.deque()  # (第一个包的 seq_num, memoryview, 包长, 在整条流里的位置)
+        self.total_segments = 0  # 到目前为止 send() 进来的数据一共分成了多少个包
+        self.total_bytes = 0  # 到目前为止 send() 进来多少 byte
+        self.mss = Segment.MAX_PAYLOAD_SIZE  # 新的数据按多长切包，MSSProber 会改
+        self.flags = bytearray(self.capacity)
+        self.send_times = array.array("d", bytes(8 * self.capacity))  # 每个包最后一次发出去的时间
+        self.retransmitted = bytearray(self.capacity)  # 重传过的包不采 RTT 样本 (Karn)
+        self.fast_retransmitted = bytearray(self.capacity)  # 快速重传过的包不再快速重传第二次
+        self.recovery_point = 0  # 快速恢复的时候的 next_seq_num，send_base 越过它之前不再减窗口
+        self.send_base = 0
+        self.next_seq_num = 0
+        self.next_send_time = 0.0  # pacing 的时候下一个包最早什么时候能发
+        self.loss_time = 0.0  # 上一次因为超时通知拥塞控制的时间
+        self.window_end = None  # 对面通告的接收窗口到哪 (ack_num + window)，这个 seq_num 开始不能发，对面没通告过是 None
+        self.lock = threading.Lock()  # send() 主循环、dispatcher 线程、scheduler 线程都要改上面这些
+        self.changed = threading.Condition(self.lock)  # 窗口滑动、对面关了的时候通知 send()
+        self._local = threading.local()  # send() 主循环发新包，scheduler 线程重传，各用各的缓冲区
+
+    def push(self, data: bytes):
+        data = memoryview(data).cast("B")
+        if len(data):
+            self.chunks.append((self.total_segments, data, self.mss, self.total_bytes))
+            self.total_segments += math.ceil(len(data) / self.mss)
+            self.total_bytes += len(data)
+
+    def set_mss(self, mss: int):
+        """之后发的包按 mss 切: 还没发的数据从 next_seq_num 开始重新切，已经发了的包不动"""
+        if mss == self.mss:
+            return
+        self.mss = mss
+        unsent = []
+        while self.chunks:
+            first, data, size, offset = self.chunks[-1]
+            sent = max(self.next_seq_num - first, 0)  # 这一块发了几个包
+            if sent * size >= len(data):
+                break
+            self.chunks.pop()
+            if sent:
+                self.chunks.append((first, data[:sent * size], size, offset))
+                data = data[sent * size:]
+            unsent.append(data)
+        self.total_segments = self.next_seq_num
+        self.total_bytes -= sum(len(data) for data in unsent)
+        for data in reversed(unsent):
+            self.push(data)
+
+    def offset(self, seq_num: int) -> int:
+        """第 seq_num 个包在整条流里从第几个 byte 开始，seq_num=total_segments 就是流的末尾"""
+        for first, data, size, offset in reversed(self.chunks):
+            if first <= seq_num:
+                return offset + min((seq_num - first) * size, len(data))
+        return self.total_bytes
+
+    def send_limit(self, cwnd: float) -> int:
+        """第一个现在不能发的 seq_num: 拥塞窗口、接收窗口 (SACK 位图覆盖的范围和对面通告的) 取最小"""
+        limit = self.send_base + min(int(cwnd), ReceiverState.RECV_WINDOW_SIZE)
+        return limit if self.window_end is None else min(limit, self.window_end)
+
+    def window_closed(self) -> bool:
+        """对面的接收窗口关了而且没有在飞的包，不会再有 ack 来告诉我们窗口开了"""
+        return self.window_end is not None and self.window_end <= self.next_seq_num == self.send_base
+
+    def has_unsent(self) -> bool:
+        return self.next_seq_num < self.total_segments
+
+    def idle(self) -> bool:
+        """send() 进来的数据是不是全都 ack 了"""
+        return self.send_base == self.total_segments
+
+    def in_flight(self, seq_num: int) -> bool:
+        return self.send_base <= seq_num < self.next_seq_num and self.flags[seq_num % self.capacity] == 2
+
+    def new_segment(self) -> int:
+        """把下一个还没发的包标记成发了，返回它的 seq_num"""
+        seq_num = self.next_seq_num
+        slot = seq_num % self.capacity
+        self.flags[slot] = 2
+        self.retransmitted[slot] = False
+        self.fast_retransmitted[slot] = False
+        self.next_seq_num += 1
+        return seq_num
+
+    def slide(self):
+        while self.send_base < self.next_seq_num and self.flags[self.send_base % self.capacity] == 1:
+            self.flags[self.send_base % self.capacity] = 0
+            self.send_base += 1
+        while len(self.chunks) > 1 and self.chunks[1][0] <= self.send_base:
+            self.chunks.popleft()  # 这一块全都 ack 了
+        if self.chunks and self.idle():
+            self.chunks.clear()
+
+    def payload(self, seq_num: int) -> memoryview:
+        for first, data, size, _ in reversed(self.chunks):
+            if first <= seq_num:
+                break
+        j = (seq_num - first) * size
+        return data[j:j + size]  # memoryview 切片不拷贝，超长的话自动取到最后一位
+
+    def segment(self, seq_num: int) -> "Segment":
+        payload = self.payload(seq_num)
+        return Segment(seq_num=seq_num, length=len(payload), payload=payload, conn_id=self.conn_id)
+
+    def encode(self, seq_num: int, version: int, ack: tuple = None) -> memoryview:
         """
-        Finish the connection and release resources. For simplicity, assume that
-        after a socket is closed, neither futher sends nor receives are allowed.
+        把第 seq_num 个包编码进可以重复使用的缓冲区，返回的 memoryview 在这个线程下一次 encode 之前有效
+        这个包要是已经 ack 了就返回 None，它所在的那块数据可能已经扔掉了 (重传的时候 ack 刚好到了)
+        ack 是 (累计确认, 接收窗口) 的话捎带上
         """
-        super().close()
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = bytearray(Segment.MAX_SEGMENT_SIZE)
+        with self.lock:
+            if not self.in_flight(seq_num):
+                return None
+            segment = self.segment(seq_num)
+        if ack is not None:
+            segment.ack = True
+            segment.ack_num, segment.window = ack
+        size = segment.encode_into(buffer, version)
+        return memoryview(buffer)[:size]
+
+
+class ReceiverState:
+    """
+    一个连接的 SR 接收状态，dispatcher 线程往里放，recv() 从里面拿，延迟 ack 的闹钟是在 scheduler 线程里回的，所以要一把锁
 
-    def set_connect_addr(self, addr):
-        self._connect_addr = addr
+    乱序收到的 payload 放在固定大小的环 slots[seq % RECV_WINDOW_SIZE] 里，收到了连续的包之后就挪到 ready 队列里，
+    recv() 每次从 ready 里拿最多 bufsize 个 byte，对面 close() 了 (eof) 而且 ready 拿空了就返回 b''
+    payload 都是收到的包上的 memoryview (Segment.decode 不拷贝)，recv()/recv_into() 的时候才拷一次，拷进调用者要的地方
+
+    流量控制: ready 最多攒 READY_LIMIT 个 byte，剩下的空间换算成还能收几个包 (window())，每个 ack 都带上，
+    发送方在飞的包不超过 min(cwnd, 对面的窗口)，recv() 慢的时候发送方停下来等，不会白发被丢掉
+    """
+
+    RECV_WINDOW_SIZE = 32  # 接收窗口大小，SACK 位图就覆盖这么大；两边跑的是同一份代码，发送方也按这个限制窗口
+    ACK_EVERY = 2  # 按顺序收到几个包回一次 ack
+    DELAYED_ACK_TIMEOUT = 0.04  # 没攒够也最多等这么久就回
+    READY_LIMIT = 1 << 20  # ready 里最多攒多少 byte 没被 recv() 拿走的数据，满了就通告窗口 0
+
+    def __init__(self):
+        self.recv_window_size = self.RECV_WINDOW_SIZE
+        self.recv_base = 0
+        self.slots = [None] * self.recv_window_size  # 乱序收到的 payload 放在 seq % recv_window_size 的槽里
+        self.buffered = 0  # slots 里有几个包
+        self.segment_size = Segment.MAX_PAYLOAD_SIZE  # 收到过的最长的 payload，窗口按这个换算成包数
+        self.advertised = self.recv_window_size  # 上一次 ack 里通告的窗口
+        self.advertised_end = self.recv_window_size  # 上一次通告的窗口到哪，发送方可以一直发到这
+        self.ready = collections.deque()  # 按顺序收到了、还没被 recv() 拿走的 payload (memoryview)
+        self.ready_size = 0  # ready 里一共多少 byte
+        self.eof = False  # 对面 close() 了
+        self.unacked = 0  # 收到了但是还没回 ack 的包数
+        self.delivered = {}  # 最近交付的 FECController.MAX_GROUP 个包，FEC 补包的时候要用同一组里已经交付了的
+        self.parities = {}  # 一组第一个包的 seq_num -> 还缺不止一个包、暂时补不了的校验包
+        self.decompressor = None  # 对面发的是压缩过的帧的话，按顺序交付的数据先过一遍这个，见 compression.py
+        self.error = None  # 帧坏了解不开，后面的流都接不上了，recv() 把解出来的拿完之后抛这个
+        self.lock = threading.Lock()
+        self.readable = threading.Condition(self.lock)  # recv() 在这上面等数据
+
+    def get(self, seq_num: int):
+        """窗口里收到了的 payload，没收到或者不在窗口里是 None"""
+        if self.recv_base <= seq_num < self.recv_base + self.recv_window_size:
+            return self.slots[seq_num % self.recv_window_size]
+        return None
+
+    def put(self, seq_num: int, payload: bytes):
+        """seq_num 要在 [recv_base, recv_base + recv_window_size) 里"""
+        slot = seq_num % self.recv_window_size
+        if self.slots[slot] is None:
+            self.buffered += 1
+        self.slots[slot] = payload
+        self.segment_size = max(self.segment_size, len(payload))
+        if seq_num != self.recv_base:
+            return
+        while self.slots[self.recv_base % self.recv_window_size] is not None:  # 交付数据，滑动窗口
+            slot = self.recv_base % self.recv_window_size
+            payload, self.slots[slot] = self.slots[slot], None
+            self.buffered -= 1
+            for chunk in self.decompress(payload):
+                self.ready.append(chunk)
+                self.ready_size += len(chunk)
+            self.delivered[self.recv_base] = payload
+            self.delivered.pop(self.recv_base - FECController.MAX_GROUP, None)
+            self.recv_base += 1
+        self.readable.notify_all()
+
+    def decompress(self, payload) -> list:
+        """
+        按顺序交付的 payload 过一遍 decompressor，对面没压缩就是原样
+        解不开的话 (帧头坏了、body 解压出错) 连接就废了: 记下错误、当成 eof，之后收到的都扔掉
+        """
+        if self.decompressor is None:
+            return [payload]
+        if self.error is not None:
+            return []
+        try:
+            return self.decompressor.feed(payload)
+        except ValueError as e:
+            self.error = ConnectionError("Corrupted compressed stream: " + str(e))
+            self.eof = True
+            return []
+
+    def add_parity(self, parity: "Segment") -> bool:
+        """收到校验包，能补就补，返回是不是补了一个包，要在持有 lock 的时候调"""
+        first, k = parity.seq_num, parity.fec[0]
+        if first + k <= self.recv_base or first >= self.recv_base + self.recv_window_size:
+            return False  # 这一组早就收全了，或者太远了
+        self.parities[first] = parity
+        return self.repair(first)
+
+    def repair(self, seq_num: int) -> bool:
+        """
+        seq_num 所在的组有校验包而且只缺一个包的话把它补出来，返回是不是补了，要在持有 lock 的时候调
+        缺的包 = 校验包 XOR 组里别的包，长度 = 长度的 XOR 再 XOR 别的包的长度
+        """
+        for first, parity in list(self.parities.items()):
+            k, length = parity.fec
+            if first + k <= self.recv_base:
+                del self.parities[first]  # 收全了
+            elif first <= seq_num < first + k:
+                break
+        else:
+            return False
+
+        payloads = []
+        missing = None
+        for seq in range(first, first + k):
+            if seq < self.recv_base:
+                payload = self.delivered.get(seq)
+                if payload is None:
+                    return False  # 交付太久了，已经不在 delivered 里了
+            else:
+                payload = self.get(seq)
+            if payload is not None:
+                payloads.append(payload)
+                length ^= len(payload)
+            elif missing is None:
+                missing = seq
+            else:
+                return False  # 缺了不止一个，等重传
+        if missing is not None and missing >= self.recv_base + self.recv_window_size:
+            return False  # 缺的包在窗口外面，先留着
+        del self.parities[first]
+        if missing is None:
+            return False
+
+        size = len(parity.payload)
+        data = (xor_payloads(payloads, size) ^ int.from_bytes(parity.payload, "big")).to_bytes(size, "big")
+        self.put(missing, memoryview(data)[:length])
+        return True
+
+    def take(self, size: int) -> list:
+        """
+        从 ready 里拿走最多 size 个 byte，返回一串 memoryview，要在持有 lock 的时候调
+        一个包拿了一半的话剩下的那半还留在队头
+        """
+        chunks = []
+        while self.ready and size > 0:
+            chunk = self.ready[0]
+            if len(chunk) > size:
+                self.ready[0] = chunk[size:]
+                chunk = chunk[:size]
+            else:
+                self.ready.popleft()
+            chunks.append(chunk)
+            size -= len(chunk)
+            self.ready_size -= len(chunk)
+        return chunks
+
+    def read_into(self, buffer: memoryview) -> int:
+        """把 ready 里的数据直接拷进 buffer，返回拷了多少 byte，要在持有 lock 的时候调"""
+        n = 0
+        for chunk in self.take(len(buffer)):
+            buffer[n:n + len(chunk)] = chunk
+            n += len(chunk)
+        return n
+
+    def has_gap(self) -> bool:
+        """窗口里是不是有乱序收到的包 (前面还缺着)"""
+        return self.buffered > 0
+
+    def sack_bitmap(self) -> bytes:
+        """
+        recv_base 本身一定还没收到，所以位图从 recv_base+1 开始，第 i 位 (最高位开始) 表示 recv_base+1+i 收到了
+        """
+        bits = [self.slots[seq % self.recv_window_size] is not None
+                for seq in range(self.recv_base + 1, self.recv_base + self.recv_window_size)]
+        return Segment.encode_sack(bits)
+
+    def window(self) -> int:
+        """从 recv_base 开始还能收几个包: ready 剩下的空间按收到过的最长的包换算，不超过 recv_window_size"""
+        free = self.READY_LIMIT - self.ready_size
+        return max(0, min(self.recv_window_size, free // self.segment_size))
+
+    def advertise(self) -> int:
+        """ack 里要通告的窗口，记下来，要在持有 lock 的时候调"""
+        self.advertised = self.window()
+        self.advertised_end = self.recv_base + self.advertised
+        return self.advertised
+
+    def accepts(self, seq_num: int) -> bool:
+        """
+        通告过的窗口里的包都收 (窗口按包长换算有误差，不能让守规矩的发送方白发)，
+        ready 满了之后窗口外面的就不收了 (不认识窗口的老版本)，乱序的包只能放在环里，所以不会超过 recv_window_size
+        """
+        end = self.recv_base + self.recv_window_size
+        if self.ready_size >= self.READY_LIMIT:
+            end = min(end, self.advertised_end)
+        return seq_num < end
+
+    def reopened(self) -> bool:
+        """上一次通告的窗口是 0，recv() 拿走数据之后又能收了，要马上告诉发送方，要在持有 lock 的时候调"""
+        return self.advertised == 0 and self.window() > 0
 
 
 class Segment:
     """
+    老格式 (版本 0, 21 byte):
+
     field       length          range               type
     --------------------------------------------------------------
     checksum   2 byte=16 bit   0 ~ 65535           unsigned short
@@ -456,17 +1555,65 @@ class Segment:
     seq_num    4 byte=32 bit   0 ~ 4294967295      unsigned int
     ack_num    4 byte=32 bit   0 ~ 4294967295      unsigned int
     length     4 byte=32 bit   0 ~ 4294967295      unsigned int
+    conn_id    4 byte=32 bit   0 ~ 4294967295      unsigned int
     payload    0 ~ length byte -                   bytes
+
+    新格式 (版本 1 和 2, 15 byte + 扩展):
+
+    field       length          range               type
+    --------------------------------------------------------------
+    checksum   2 byte=16 bit   0 ~ 65535           unsigned short
+    flags      1 byte          高 4 位版本号，低 4 位 EXT|ACK|FIN|SYN
+    seq_num    4 byte=32 bit   0 ~ 4294967295      unsigned int
+    ack_num    4 byte=32 bit   0 ~ 4294967295      unsigned int
+    conn_id    4 byte=32 bit   0 ~ 4294967295      unsigned int
+    扩展        有 EXT 的时候才有，一串 (type 1 byte, length 1 byte, 值)，type=0 (OPT_END) 结束
+    payload    剩下的全是
+
+    length 没了，payload 多长看 UDP 包多长就知道。老格式里 sack 和握手的 MSS 是放在 payload 里的，新格式放在扩展里
+    两种格式第 3 个 byte 不一样: 老格式是 syn (0 或 1)，新格式的高 4 位是版本号，所以 decode 不用知道对面是哪个版本
+    syn 永远用老格式发 (老版本的 server 也认识)，payload 里带上我们认识的最高版本，server 取两边都认识的回 synack，
+    以后这个连接就都用 synack 的格式
+    版本 2 的 header 跟版本 1 一样，只是数据包可以带 ACK flag，这时候 ack_num 是捎带的累计确认 (两个方向都有数据的时候不用单独回 ack)，
+    版本 1 的数据包 ACK 一定是 0，所以只有两边都认识版本 2 才捎带
+
+    conn_id 是单端口多路复用的 server 分配的连接号，0 表示没有 (每个连接自己一个端口)
     """
 
+    # 每个收发的包都是一个 Segment，不要 __dict__，对象小一半，建得也快
+    __slots__ = ("syn", "fin", "ack", "seq_num", "ack_num", "length", "checksum", "payload", "conn_id", "sack", "mss",
+                 "fec", "version", "max_version", "compression", "window")
+
     MAX_NUM = 4294967295  # 2^32-1 (32位无符号)
     # python3 的 int 没有范围限制, 不会 overflow 除非大到电脑内存满了
 
-    MAX_PAYLOAD_SIZE = 1007  # 最长 payload 长度，在 send() 里分段的时候用，拥塞的时候可以减小
-    MAX_SEGMENT_SIZE = MAX_PAYLOAD_SIZE + 17
+    LEGACY_VERSION = 0
+    VERSION = 2  # 现在认识的最高版本
+    PIGGYBACK_VERSION = 2  # 从这个版本开始数据包捎带 ack
+
+    SYN = 0x01
+    FIN = 0x02
+    ACK = 0x04
+    EXT = 0x08  # header 后面有扩展
+
+    OPT_END = 0
+    OPT_SACK = 1  # SACK 位图
+    OPT_MSS = 2  # 这一端最多能收多长的 payload (syn/synack)
+    OPT_FEC = 3  # 校验包: 这一组几个包、它们长度的 XOR，seq_num 是这一组第一个包
+    OPT_COMPRESSION = 4  # 这一端能解哪些压缩、想用哪个压 (synack)，见 compression.py
+    OPT_WINDOW = 5  # ack (单独的或者捎带的): 接收窗口，从 ack_num 开始还能收几个包
+    KNOWN_OPTIONS = (OPT_SACK, OPT_MSS, OPT_FEC, OPT_COMPRESSION, OPT_WINDOW)
+
+    HEADER_SIZE = 21
+    COMPACT_HEADER_SIZE = 15
+    MAX_PAYLOAD_SIZE = 1007  # 一开始的包长，握手没带 MSS 的 (老版本) 一直用这个，MSSProber 从这里往上试
+    MAX_MSS = 8163  # 最长的 payload: network.py (socketserver) 一次最多收 8192 byte，减掉 8 byte 地址和 header
+    MAX_SEGMENT_SIZE = MAX_MSS + HEADER_SIZE
 
     def __init__(self, syn: bool = False, fin: bool = False, ack: bool = False, seq_num: int = -1, ack_num: int = -1,
-                 length: int = 0, checksum=None, payload: bytes = None):
+                 length: int = 0, checksum=None, payload: bytes = None, conn_id: int = 0, sack: bytes = None,
+                 mss: int = None, fec: tuple = None, version: int = None, compression: int = None,
+                 window: int = None):
         self.syn = syn
         self.fin = fin
         self.ack = ack
@@ -475,18 +1622,39 @@ class Segment:
         self.length = length
         self.checksum = checksum
         self.payload = payload
+        self.conn_id = conn_id
+        self.sack = sack
+        self.mss = mss
+        self.fec = fec
+        self.version = version  # 收到的包是哪个格式的，自己建的包是 None
+        self.compression = compression  # syn/synack: 压缩的 offer，老版本不带是 None
+        self.window = window  # ack: 对面的接收窗口 (包数)，老格式和老版本不带是 None
+        self.max_version = Segment.VERSION  # syn/synack: 发的那边认识的最高版本
 
     def __str__(self):
         return ("----------------------------------------------\n" +
                 "syn=" + str(self.syn) + ", " + "fin=" + str(self.fin) + ", " + "ack=" + str(self.ack) + "\n" +
-                "seq_num=" + str(self.seq_num) + ", " + "ack_num=" + str(self.ack_num) + "\n" +
+                "seq_num=" + str(self.seq_num) + ", " + "ack_num=" + str(self.ack_num) + ", " +
+                "conn_id=" + str(self.conn_id) + ", " + "version=" + str(self.version) + "\n" +
                 "length=" + str(self.length) + "\n" + "checksum=" + str(self.checksum) + "\n" +
-                "payload=" + (self.payload.decode() if self.payload else "None") + "\n" +
+                "payload=" + (bytes(self.payload).decode(errors="replace") if self.payload else "None") + "\n" +
                 "---------------------------------------------------------------\n")
 
-    def encode(self) -> bytes:
+    def encode(self, version: int = LEGACY_VERSION) -> bytes:
+        """
+        将报文编码成字节流，version 是连接握手商量好的 header 格式
         """
-        将报文编码成字节流
+        # 够大就行，新格式的 header 比老格式短
+        data = bytearray(Segment.HEADER_SIZE + (len(self.payload) if self.payload else 0) +
+                         (len(self.sack) + 3 if self.sack else 0) + (MSS_OPTION.size + 3 if self.mss else 0) +
+                         (FEC_OPTION.size + 3 if self.fec else 0) + (3 if self.compression is not None else 0) +
+                         (WINDOW_OPTION.size + 3 if self.window is not None else 0))
+        return bytes(memoryview(data)[:self.encode_into(data, version)])
+
+    def encode_into(self, buffer, version: int = LEGACY_VERSION) -> int:
+        """
+        将报文直接编码进 buffer (bytearray 之类可写的)，返回编码后的长度
+        header 用提前编译好的 HEADER/COMPACT_HEADER.pack_into 写进去，payload 只拷贝这一次
 
         ! 表示网络传输
         ? 表示 bool        (1 byte)
@@ -494,32 +1662,137 @@ class Segment:
         H 表示 无符号short  (2 byte)
         B 表示 无符号char   (1 byte)
         """
-        self.checksum = Segment.calculate_checksum(self)
+        payload = self.payload
 
         # checksum 要放第一位，否则检查 checksum 的时候会错开 1 位，因为 header 的总长度是奇数
-        data = bytearray(
-            struct.pack("!H???III", self.checksum, self.syn, self.fin, self.ack, self.seq_num, self.ack_num,
-                        self.length))
-        # 现在 header 封装完毕，header 长度为 17 byte (2+1+1+1+4+4+4)
-        # XXX: 三个 bit 其实用一个 byte 表示就够了, header 长度减小到 15 byte
-
-        if self.payload:
-            data.extend(self.payload)  # 在后面加上数据
+        # 先把 checksum 当 0 写进去，在最终的字节流上算一遍 checksum 再填回第一位，不用再单独 pack 一份 header
+        if version == Segment.LEGACY_VERSION:
+            if self.sack is not None:
+                payload = self.sack
+            elif self.mss:
+                payload = HANDSHAKE_OPTION.pack(self.mss, Segment.VERSION, self.compression or 0)
+            offset = Segment.HEADER_SIZE
+            HEADER.pack_into(buffer, 0, 0, self.syn, self.fin, self.ack, self.seq_num, self.ack_num,
+                             len(payload) if payload else 0, self.conn_id)
+            # 现在 header 封装完毕，header 长度为 21 byte (2+1+1+1+4+4+4+4)
+        else:
+            # 三个 bit 用一个 byte 表示，length 不要了，header 长度 15 byte (2+1+4+4+4)
+            flags = version << 4 | self.syn | self.fin << 1 | self.ack << 2
+            offset = Segment.COMPACT_HEADER_SIZE
+            if self.sack or self.mss or self.fec or self.compression is not None or self.window is not None:
+                flags |= Segment.EXT
+                offset = self.encode_options(buffer, offset)
+            COMPACT_HEADER.pack_into(buffer, 0, 0, flags, self.seq_num, self.ack_num, self.conn_id)
+
+        size = offset + (len(payload) if payload else 0)
+        if size > offset:
+            buffer[offset:size] = payload  # 在后面加上数据
+
+        self.checksum = ~ones_complement_sum(memoryview(buffer)[:size]) & 0xFFFF
+        CHECKSUM.pack_into(buffer, 0, self.checksum)
 
         if DEBUG:
             print("--- send segment " + str(self))
 
-        return bytes(data)
+        return size
+
+    def encode_options(self, buffer, offset: int) -> int:
+        """新格式 header 后面的扩展，从 offset 开始写，返回扩展后面的位置"""
+        if self.sack:
+            OPTION.pack_into(buffer, offset, Segment.OPT_SACK, len(self.sack))
+            buffer[offset + 2:offset + 2 + len(self.sack)] = self.sack
+            offset += 2 + len(self.sack)
+        if self.mss:
+            OPTION.pack_into(buffer, offset, Segment.OPT_MSS, MSS_OPTION.size)
+            MSS_OPTION.pack_into(buffer, offset + 2, self.mss)
+            offset += 2 + MSS_OPTION.size
+        if self.fec:
+            OPTION.pack_into(buffer, offset, Segment.OPT_FEC, FEC_OPTION.size)
+            FEC_OPTION.pack_into(buffer, offset + 2, *self.fec)
+            offset += 2 + FEC_OPTION.size
+        if self.compression is not None:
+            OPTION.pack_into(buffer, offset, Segment.OPT_COMPRESSION, 1)
+            buffer[offset + 2] = self.compression
+            offset += 3
+        if self.window is not None:
+            OPTION.pack_into(buffer, offset, Segment.OPT_WINDOW, WINDOW_OPTION.size)
+            WINDOW_OPTION.pack_into(buffer, offset + 2, self.window)
+            offset += 2 + WINDOW_OPTION.size
+        buffer[offset] = Segment.OPT_END
+        return offset + 1
+
+    def decode_options(self, data, offset: int) -> int:
+        """
+        读新格式 header 后面的扩展，返回 payload 开始的位置，不认识的扩展跳过
+        扩展是对面写的，checksum 对了也不一定完整 (没有 OPT_END、长度超出包尾、值比格式短)，这种返回 None
+        """
+        end = len(data)
+        while True:
+            if offset >= end:
+                return None
+            if data[offset] == Segment.OPT_END:
+                return offset + 1
+            if offset + OPTION.size > end:
+                return None
+            kind, size = OPTION.unpack_from(data, offset)
+            if offset + OPTION.size + size > end:
+                return None
+            value = data[offset + OPTION.size:offset + OPTION.size + size]
+            if kind == Segment.OPT_SACK:
+                self.sack = value
+            elif kind == Segment.OPT_MSS and size >= MSS_OPTION.size:
+                self.mss = MSS_OPTION.unpack_from(value)[0]
+            elif kind == Segment.OPT_FEC and size >= FEC_OPTION.size:
+                self.fec = FEC_OPTION.unpack_from(value)
+            elif kind == Segment.OPT_COMPRESSION and size >= 1:
+                self.compression = value[0]
+            elif kind == Segment.OPT_WINDOW and size >= WINDOW_OPTION.size:
+                self.window = WINDOW_OPTION.unpack_from(value)[0]
+            elif kind in Segment.KNOWN_OPTIONS:
+                return None  # 认识的扩展，值却比格式短
+            offset += OPTION.size + size
 
     @staticmethod
     def decode(data: bytes) -> "Segment":
         """
-        将收到的字节流解码为报文
+        将收到的字节流解码为报文，第 3 个 byte 的高 4 位看是哪个格式
+        header 不完整的包 (比 header 短、扩展坏了) 返回 None，调用的人当坏包丢掉
         """
-        checksum, syn, fin, ack, seq_num, ack_num, length = struct.unpack("!H???III", data[:17])
-        # 注意 python 没有 short 类型, checksum 是个 int
-        payload = data[17:]  # 注意如果 data 里没有数据的话, 这里 payload=b'' 空字符串
-        segment = Segment(syn, fin, ack, seq_num, ack_num, length, checksum, payload)
+        data = memoryview(data)  # 不拷贝，payload 是 data 上的 memoryview，没有数据的话长度是 0
+        if len(data) < Segment.COMPACT_HEADER_SIZE:
+            return None
+        if data[2] >> 4 == Segment.LEGACY_VERSION:
+            if len(data) < Segment.HEADER_SIZE:
+                return None
+            checksum, syn, fin, ack, seq_num, ack_num, length, conn_id = HEADER.unpack_from(data)
+            # 注意 python 没有 short 类型, checksum 是个 int
+            payload = data[Segment.HEADER_SIZE:]
+            segment = Segment(syn, fin, ack, seq_num, ack_num, length, checksum, payload, conn_id,
+                              version=Segment.LEGACY_VERSION)
+            segment.max_version = Segment.LEGACY_VERSION
+            # 老格式的 sack 和 MSS 在 payload 里
+            if segment.is_ack():
+                segment.sack, segment.payload = payload, payload[:0]
+            elif syn and len(payload) >= MSS_OPTION.size:
+                segment.mss = MSS_OPTION.unpack_from(payload)[0]
+                if len(payload) > MSS_OPTION.size:  # 再老一点的版本只有 MSS
+                    segment.max_version = payload[2]
+                if len(payload) >= HANDSHAKE_OPTION.size:
+                    segment.compression = payload[3]
+                segment.payload = payload[:0]
+        else:
+            checksum, flags, seq_num, ack_num, conn_id = COMPACT_HEADER.unpack_from(data)
+            offset = Segment.COMPACT_HEADER_SIZE
+            segment = Segment(flags & Segment.SYN != 0, flags & Segment.FIN != 0, flags & Segment.ACK != 0,
+                              seq_num, ack_num, len(data) - offset, checksum, data[offset:], conn_id,
+                              None, None, None, flags >> 4)
+            segment.max_version = segment.version
+            if flags & Segment.EXT:
+                offset = segment.decode_options(data, offset)
+                if offset is None:
+                    return None
+                segment.payload = data[offset:]
+                segment.length = len(segment.payload)
 
         if DEBUG:
             print("--- recv segment " + str(segment))
@@ -529,48 +1802,60 @@ class Segment:
     @staticmethod
     def calculate_checksum(segment: "Segment") -> int:
         """
-        用除了 checksum 之外的所有字段算 checksum
+        用除了 checksum 之外的所有字段算 checksum (老格式)
+        encode() 里已经不用这个了，直接在最终的字节流上算
         """
-        temp = bytearray(struct.pack("!???III", segment.syn, segment.fin, segment.ack, segment.seq_num, segment.ack_num,
-                                     segment.length))
+        temp = bytearray(HEADER.pack(0, segment.syn, segment.fin, segment.ack, segment.seq_num, segment.ack_num,
+                                     segment.length, segment.conn_id))
         if segment.payload:
             temp.extend(segment.payload)
-        i = iter(temp)
-        bytes_sum = sum((a << 8) + b for a, b in zip(i, i))  # for a, b: (s[0], s[1]), (s[2], s[3]), ...
-        if len(temp) % 2 == 1:  # pad zeros to form a 16-bit word for checksum
-            bytes_sum += temp[-1] << 8
-        # add the overflow 1 at the end (adding twice is sufficient)
-        bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
-        bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
-        return ~bytes_sum & 0xFFFF
+        return ~ones_complement_sum(temp) & 0xFFFF
 
     @staticmethod
     def check_checksum(data: bytes) -> bool:
-        i = iter(data)
-        bytes_sum = sum((a << 8) + b for a, b in zip(i, i))
-        if len(data) % 2 == 1:
-            bytes_sum += data[-1] << 8
-        bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
-        bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
-        return bytes_sum & 0xFFFF == 0xFFFF
+        return ones_complement_sum(data) == 0xFFFF
 
     # seq_num=ack_num=-1 表示这是握手报文段
     # 编码的时候 -1 会编码成 4294967295
+    # syn 带 client 最多能收多长的 payload，synack 带商量好的 (两边取小的)，以后两个方向都不超过这个
     @staticmethod
-    def syn_handshake(seq_num=-1, ack_num=-1):
-        return Segment(syn=True, fin=False, ack=False, seq_num=seq_num, ack_num=ack_num)
+    def syn_handshake(seq_num=-1, ack_num=-1, conn_id=0, mss=None, compression=None):
+        return Segment(syn=True, fin=False, ack=False, seq_num=seq_num, ack_num=ack_num, conn_id=conn_id, mss=mss,
+                       compression=compression)
 
     @staticmethod
-    def synack_handshake(seq_num=-1, ack_num=-1):
-        return Segment(syn=True, fin=False, ack=True, seq_num=seq_num, ack_num=ack_num)
+    def synack_handshake(seq_num=-1, ack_num=-1, conn_id=0, mss=None, compression=None):
+        return Segment(syn=True, fin=False, ack=True, seq_num=seq_num, ack_num=ack_num, conn_id=conn_id, mss=mss,
+                       compression=compression)
 
+    def mss_option(self) -> int:
+        """syn/synack 里带的 MSS，对面是不带这个的老版本就是 MAX_PAYLOAD_SIZE"""
+        return self.mss or Segment.MAX_PAYLOAD_SIZE
+
+    @staticmethod
+    def ack_handshake(seq_num=-1, ack_num=-1, conn_id=0):
+        return Segment(syn=False, fin=False, ack=True, seq_num=seq_num, ack_num=ack_num, conn_id=conn_id)
+
+    @staticmethod
+    def fin_handshake(seq_num=-1, ack_num=-1, conn_id=0):
+        return Segment(syn=False, fin=True, ack=False, seq_num=seq_num, ack_num=ack_num, conn_id=conn_id)
+
+    # 包长探测: syn 和 fin 同时是 1，老版本哪种包都不是，直接扔掉，不会当成握手或者数据
+    # seq_num 是探测包的编号，payload 只是填充；ack 把编号原样带回来，不带填充
     @staticmethod
-    def ack_handshake(seq_num=-1, ack_num=-1):
-        return Segment(syn=False, fin=False, ack=True, seq_num=seq_num, ack_num=ack_num)
+    def mss_probe(probe_id, padding=b"", conn_id=0):
+        return Segment(syn=True, fin=True, ack=False, seq_num=probe_id, payload=padding, length=len(padding),
+                       conn_id=conn_id)
 
     @staticmethod
-    def fin_handshake(seq_num=-1, ack_num=-1):
-        return Segment(syn=False, fin=True, ack=False, seq_num=seq_num, ack_num=ack_num)
+    def mss_probe_ack(probe_id, conn_id=0):
+        return Segment(syn=True, fin=True, ack=True, seq_num=probe_id, conn_id=conn_id)
+
+    def is_mss_probe(self) -> bool:
+        return self.syn and self.fin and not self.ack
+
+    def is_mss_probe_ack(self) -> bool:
+        return self.syn and self.fin and self.ack
 
     def is_syn_handshake(self) -> bool:
         return self.syn and not self.fin and not self.ack
@@ -579,29 +1864,346 @@ class Segment:
         return self.syn and not self.fin and self.ack
 
     def is_ack_handshake(self) -> bool:
-        return not self.syn and not self.fin and self.ack
+        return not self.syn and not self.fin and self.ack and self.seq_num == self.MAX_NUM
 
     def is_fin_handshake(self) -> bool:
         return not self.syn and self.fin and not self.ack
 
+    @staticmethod
+    def data_ack(ack_num, sack=b"", conn_id=0, window=None):
+        """
+        数据的 ack: 三个 flag 都是 0，seq_num=MAX_NUM，ack_num 是累计确认 (ack_num 之前的包全收到了)
+        sack 是 SACK 位图，第 i 位 (从第一个 byte 的最高位开始) 表示 ack_num+1+i 也收到了
+        window 是接收窗口，新格式才带得上
+        """
+        return Segment(seq_num=-1, ack_num=ack_num, conn_id=conn_id, sack=sack, window=window)
+
+    @staticmethod
+    def encode_sack(bits) -> bytes:
+        bitmap = 0
+        for bit in bits:
+            bitmap = (bitmap << 1) | bool(bit)
+        size = (len(bits) + 7) // 8
+        return (bitmap << (size * 8 - len(bits))).to_bytes(size, "big")
+
+    def sacked(self) -> list:
+        """SACK 位图里标记收到了的 seq_num"""
+        if not self.sack:
+            return []
+        bitmap = int.from_bytes(self.sack, "big")
+        size = len(self.sack) * 8
+        return [self.ack_num + 1 + i for i in range(size) if bitmap >> (size - 1 - i) & 1]
+
     def is_ack(self) -> bool:
-        return not self.syn and not self.fin and not self.ack and self.seq_num == self.MAX_NUM and self.length == 0
+        return not self.syn and not self.fin and not self.ack and self.seq_num == self.MAX_NUM
+
+    def is_data(self) -> bool:
+        """ack 是 1 的数据包捎带了 ack (版本 2)，ack_num 是累计确认"""
+        return not self.syn and not self.fin and self.seq_num != self.MAX_NUM and self.fec is None
 
+    def is_parity(self) -> bool:
+        return not self.syn and not self.fin and not self.ack and self.fec is not None
+
+
+class TimerScheduler:
+    """
+    一个连接只开一个线程管所有的计时器，取代以前每个包一个 Timer 线程死循环看表
+
+    用一个最小堆按 deadline 排序，线程在 condition 上睡到最早的 deadline，到点了就调 callback(key)
+    schedule 同一个 key 会覆盖掉之前的闹钟，cancel 只是打个标记 (lazy delete)，等它浮到堆顶再扔掉
+    callback 是在 scheduler 线程里执行的，执行的时候不持有 scheduler 的锁，所以 callback 里可以再 schedule
+    """
 
-class Timer:
     def __init__(self):
-        self.closed = False
+        self._heap = []  # [deadline, 序号, key, callback]，callback=None 表示已经取消
+        self._entries = {}  # key -> 堆里对应的那一项
+        self._counter = itertools.count()  # deadline 相同的时候按 schedule 的先后
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def schedule(self, key, delay, callback):
+        with self._cond:
+            if self._closed:
+                return
+            old = self._entries.get(key)
+            if old:
+                old[3] = None
+            entry = [time.monotonic() + delay, next(self._counter), key, callback]
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+            if len(self._heap) > 2 * len(self._entries) + 64:  # 取消掉的太多了就重建一下堆
+                self._heap = [e for e in self._heap if e[3]]
+                heapq.heapify(self._heap)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._cond.notify()  # 新的闹钟比之前最早的还早，叫醒线程重新算睡多久
+
+    def cancel(self, key):
+        with self._cond:
+            entry = self._entries.pop(key, None)
+            if entry:
+                entry[3] = None
 
-    def start(self, timeout_value):
-        start = time.time()
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._heap.clear()
+            self._entries.clear()
+            self._cond.notify()
+
+    def _run(self):
         while True:
-            if self.closed:
-                break
-            end = time.time()
-            if end - start > timeout_value:
-                raise TimeoutException()
+            expired = []
+            with self._cond:
+                while not expired:
+                    if self._closed:
+                        return
+                    while self._heap and self._heap[0][3] is None:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    now = time.monotonic()
+                    if self._heap[0][0] > now:
+                        self._cond.wait(self._heap[0][0] - now)
+                        continue
+                    while self._heap and self._heap[0][0] <= now:
+                        entry = heapq.heappop(self._heap)
+                        if entry[3]:
+                            del self._entries[entry[2]]
+                            expired.append((entry[2], entry[3]))
+
+            for key, callback in expired:
+                try:
+                    callback(key)
+                except Exception as e:  # 只有这一个计时器线程，一个闹钟出错不能让别的闹钟 (还有别的连接的) 都不响了
+                    if DEBUG:
+                        print("Timer " + repr(key) + " failed: " + repr(e))
+
+
+class ScopedScheduler:
+    """
+    好几个连接共用一个 TimerScheduler: key 前面加上连接号，callback 拿到的还是原来的 key
+    close() 之后这个连接不能再 schedule，已经定了的闹钟响了也不回调
+    """
 
+    def __init__(self, scheduler: TimerScheduler, scope):
+        self._scheduler = scheduler
+        self._scope = scope
+        self._closed = False
+
+    def schedule(self, key, delay, callback):
+        if not self._closed:
+            self._scheduler.schedule((self._scope, key), delay, lambda scoped_key: self._fire(callback, scoped_key[1]))
+
+    def _fire(self, callback, key):
+        if not self._closed:
+            callback(key)
+
+    def cancel(self, key):
+        self._scheduler.cancel((self._scope, key))
+
+    def close(self):
+        self._closed = True
+
+
+class MultiplexEngine:
+    """
+    单端口多路复用的 server，RDTSocket(multiplex=True) listen() 的时候建 (第一次 accept() 会自动 listen())
+
+    以前每来一个 client，accept() 就新开一个 UDP socket (conn)，每个 conn 还有自己的 dispatcher 和计时器线程，
+    几百个 client 就是几千个线程和 fd。现在所有连接都走 server 这一个端口:
+
+        * 一个 I/O 线程用 selectors 等 server 的 socket，收到包按 header 里的 conn_id 交给对应连接的 handle_segment()
+        * 所有连接共用一个 TimerScheduler 线程
+        * syn 的 conn_id 是 0，engine 分配一个新的连接号放在 synack 里回过去，client 以后每个包都带着它
+        * 同一个地址重发的 syn 只重回 synack，不会再建一个连接，所以 accept() 不用再等 1s，syn 直接在 server 的端口上收
+
+    不管有多少连接，engine 只占两个线程和一个 fd
+    server.close() 之后不再接受新连接，但已经建好的连接还能用，最后一个连接关掉的时候才真的关端口
+    """
+
+    def __init__(self, server: RDTSocket, backlog: int = RDTSocket.LISTEN_BACKLOG):
+        self.server = server
+        self.scheduler = TimerScheduler()
+        self.connections = {}  # conn_id -> MultiplexedConnection
+        self.addresses = {}  # client 地址 -> conn_id
+        self.accept_queue = queue.Queue(backlog)  # 握手完了、还没被 accept() 拿走的连接
+        self.lock = threading.Lock()
+        self._conn_ids = itertools.count(1)
+        self._accepting = True
+        self._closed = False
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(server, selectors.EVENT_READ)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def accept(self) -> ("MultiplexedConnection", (str, int)):
+        conn = self.accept_queue.get()
+        if DEBUG:
+            print("Accept OK")
+        return conn, conn._connect_addr
+
+    def _run(self):
+        while not self._closed:
+            # 隔 POLL_INTERVAL 醒一次看看是不是关了
+            for _ in self._selector.select(RDTSocket.POLL_INTERVAL):
+                data, addr = self.server.recvfrom(RDTSocket.RECV_BUFFER_SIZE)
+                # checksum 不对，或者 header 不完整 (比 header 短、扩展坏了)，直接丢弃，等对面超时重发
+                segment = Segment.decode(data) if Segment.check_checksum(data) else None
+                if segment is None:
+                    if DEBUG:
+                        print("Received corrupted data")
+                    continue
+                # 所有连接共用这一个线程，一个包处理出错只丢这个包，不能让线程退出
+                try:
+                    self.on_segment(segment, addr)
+                except Exception as e:
+                    if DEBUG:
+                        print("Dropped malformed segment: " + repr(e))
+        self._selector.close()
+        UnreliableSocket.close(self.server)
+
+    def on_segment(self, segment: Segment, addr):
+        if segment.is_syn_handshake():
+            self.on_syn(segment, addr)
+            return
+
+        conn = self.connections.get(segment.conn_id)
+        if conn is None or conn._connect_addr != addr:
+            if segment.is_fin_handshake():
+                # 连接已经关了，是对面没收到我们的 ack 又重发的 fin，直接回
+                self.server.sendto(Segment.ack_handshake(conn_id=segment.conn_id).encode(segment.version), addr)
+            elif DEBUG:
+                print("A stranger is sending data to me")
+            return
+        conn.handle_segment(segment)
+
+    def on_syn(self, syn: Segment, addr):
+        with self.lock:
+            conn_id = self.addresses.get(addr)
+            if conn_id is None:
+                if not self._accepting or self.accept_queue.full():
+                    return  # backlog 满了，client 会重发 syn
+                conn_id = next(self._conn_ids)
+                conn = MultiplexedConnection(self, conn_id, addr)
+                conn._mss.max_mss = min(syn.mss_option(), Segment.MAX_MSS)
+                conn._version = min(syn.max_version, Segment.VERSION)
+                conn.negotiate_compression(syn.compression)
+                self.connections[conn_id] = conn
+                self.addresses[addr] = conn_id
+                self.accept_queue.put(conn)
+            conn = self.connections[conn_id]
+        # 发回去的 synack 可能丢包，client 会继续发 syn 过来，再回一次就行
+        synack = Segment.synack_handshake(conn_id=conn_id, mss=conn._mss.max_mss, compression=offer(conn._algorithm))
+        self.server.sendto(synack.encode(conn._version), addr)
+
+    def remove(self, conn: "MultiplexedConnection"):
+        with self.lock:
+            self.connections.pop(conn._conn_id, None)
+            if self.addresses.get(conn._connect_addr) == conn._conn_id:
+                del self.addresses[conn._connect_addr]
+            self._stop_if_done()
+
+    def close(self):
+        with self.lock:
+            self._accepting = False
+            self._stop_if_done()
+
+    def _stop_if_done(self):
+        if not self._accepting and not self.connections:
+            self._closed = True
+            self.scheduler.close()
+
+
+class MultiplexedConnection(RDTSocket):
+    """
+    MultiplexEngine 上的一个连接，用法跟 accept() 出来的 conn 一样 (send, recv, close)
+    自己不开 UDP socket 也不开线程: 收包靠 engine 的 I/O 线程调 handle_segment()，发包走 server 的端口，计时器用 engine 共用的那个
+    """
+
+    def __init__(self, engine: MultiplexEngine, conn_id: int, addr):
+        # 不调 UnreliableSocket.__init__，不然每个连接又是一个 socket
+        self._engine = engine
+        self._rate = engine.server._rate
+        self._multiplex = False
+        self._mux = None
+        self._init_connection(ScopedScheduler(engine.scheduler, conn_id), type(engine.server._cc),
+                              engine.server._fec.enabled, engine.server._compression, engine.server._nodelay)
+        self._conn_id = conn_id
+        self.sendto = engine.server.sendto
+        self.set_connect_addr(addr)
+        self.start()
+
+    def start(self):
+        self._sender = SenderState(conn_id=self._conn_id)
+        self._receiver = ReceiverState()
+
+    def close(self):
+        self.finish()
+        self._closed = True
+        self._scheduler.close()
+        self._engine.remove(self)
+
+
+class TimeWaitReaper:
+    """
+    对面先 close() 的连接，我们 close() 的时候最后回的 ack 可能丢，对面会重发 fin，要有人再回一会儿 (TIME_WAIT)
+
+    以前是 close() 里 sleep 1s 让 dispatcher 接着回，server 每个连接都要白等 1s。
+    现在 close() 把 socket 交给这个后台线程就返回了，所有连接共用一个线程:
+    selectors 同时等所有 TIME_WAIT 的 socket，收到对面重发的 fin 就回 ack，每个 socket 到了 conn.TIME_WAIT 之后关掉
+    没有 socket 要等的时候线程就退出，下次再有的时候再开
+
+    多路复用的连接不用它，engine 会直接回已经关掉的连接的 fin
+    """
 
-class TimeoutException(Exception):
     def __init__(self):
-        super().__init__()
+        self._selector = selectors.DefaultSelector()
+        self._deadlines = []  # [(deadline, 序号, conn)] 最小堆
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, conn: RDTSocket):
+        conn.setblocking(False)  # 还没退出的 dispatcher 下一次 recvfrom 就会退出，以后只有这里读
+        with self._lock:
+            self._selector.register(conn, selectors.EVENT_READ, conn)
+            heapq.heappush(self._deadlines, (time.monotonic() + conn.TIME_WAIT, next(self._counter), conn))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    conn = heapq.heappop(self._deadlines)[2]
+                    self._selector.unregister(conn)
+                    UnreliableSocket.close(conn)
+                if not self._deadlines:
+                    self._thread = None
+                    return
+                timeout = self._deadlines[0][0] - now
+
+            for key, _ in self._selector.select(min(timeout, RDTSocket.POLL_INTERVAL)):
+                self.on_readable(key.data)
+
+    @staticmethod
+    def on_readable(conn: RDTSocket):
+        try:
+            data, addr = conn.recvfrom(RDTSocket.RECV_BUFFER_SIZE)
+        except OSError:
+            return  # 被还没退出的 dispatcher 先读走了
+        if addr != conn._connect_addr or not Segment.check_checksum(data):
+            return
+        segment = Segment.decode(data)
+        if segment is not None and segment.is_fin_handshake():
+            conn.sendto(Segment.ack_handshake(conn_id=conn._conn_id).encode(conn._version), addr)
+
+
+TIME_WAIT_REAPER = TimeWaitReaper()  # 所有 RDTSocket 共用
@@ -0,0 +1,94 @@
+"""
+压缩的测试: StreamCompressor 切出来的帧按任意位置切成一段一段喂给 StreamDecompressor，解出来要跟原来一样；
+坏的帧抛 ValueError；send() 报进度用的 acked_input 跨帧也只增不减
+
+python -m pytest test_compression.py
+"""
+
+import collections
+import os
+import random
+
+import pytest
+
+import rdt
+from compression import StreamCompressor, StreamDecompressor, FRAME, RAW, ZLIB, LZMA, BLOCK_SIZE
+from rdt import RDTSocket
+
+rdt.DEBUG = False
+
+TEXT = open(os.path.join(os.path.dirname(__file__), "alice.txt"), "rb").read()[:3 * BLOCK_SIZE // 2]  # 一块多一点，有两帧
+
+
+def encode(data, algorithm, auto=False) -> bytes:
+    return b"".join(frame for frame, _ in StreamCompressor(algorithm, auto).frames(data))
+
+
+def decode(stream: bytes, size: int) -> bytes:
+    decompressor = StreamDecompressor()
+    chunks = []
+    for i in range(0, len(stream), size):
+        chunks += decompressor.feed(stream[i:i + size])
+    return b"".join(bytes(chunk) for chunk in chunks)
+
+
+def test_frames_split_across_segments():
+    for algorithm in (ZLIB, LZMA):
+        stream = encode(TEXT, algorithm)
+        for size in (1, 3, FRAME.size, 1007, len(stream)):  # 帧头也会被切开
+            assert decode(stream, size) == TEXT
+
+
+def test_raw_frames_from_auto():
+    data = random.Random(0).randbytes(5000)
+    stream = encode(data, ZLIB, auto=True)  # 随机数据压不动，auto 就不压
+    assert stream[0] == RAW
+    assert decode(stream, 1000) == data
+
+
+def test_unknown_frame_kind_raises():
+    with pytest.raises(ValueError):
+        StreamDecompressor().feed(FRAME.pack(7, 3) + b"abc")
+
+
+def test_corrupt_frames_raise():
+    for algorithm in (ZLIB, LZMA):
+        stream = bytearray(encode(TEXT, algorithm))
+        stream[FRAME.size:FRAME.size + 8] = b"\xff" * 8  # body 开头坏了
+        with pytest.raises(ValueError):
+            decode(bytes(stream), 1007)
+
+
+def marks_of(stream_sizes, input_sizes) -> collections.deque:
+    """跟 send_stream 里一样: (帧在流里从哪开始, 到哪结束, 这一帧之前用掉了多少 data, 到这一帧用掉了多少)"""
+    marks = collections.deque()
+    start = used = 0
+    for frame, block in zip(stream_sizes, input_sizes):
+        marks.append((start, start + frame, used, used + block))
+        start += frame
+        used += block
+    return marks
+
+
+def test_acked_input_is_monotonic():
+    frames, blocks = [300, 5, 1200, 40], [BLOCK_SIZE, 7, BLOCK_SIZE, 100]
+    marks = marks_of(frames, blocks)
+    progress = [RDTSocket.acked_input(marks, acked) for acked in range(sum(frames) + 10)]
+    assert progress[0] == 0
+    assert all(a <= b for a, b in zip(progress, progress[1:]))
+    assert progress[-1] == sum(blocks)
+    for i in range(1, len(frames)):  # 每一帧 ack 完刚好是这一帧之前的 data 都用掉了
+        marks = marks_of(frames, blocks)
+        assert RDTSocket.acked_input(marks, sum(frames[:i])) == sum(blocks[:i])
+
+
+def test_acked_input_without_compression():
+    marks = marks_of([5000], [5000])
+    assert [RDTSocket.acked_input(marks, acked) for acked in (0, 1234, 5000)] == [0, 1234, 5000]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
@@ -0,0 +1,69 @@
+"""
+FEC 补包的测试: FECController 算出来的校验包交给 ReceiverState，一组里缺一个马上补出来，缺两个先留着等重传
+
+python -m pytest test_fec.py
+"""
+
+import rdt
+from rdt import FECController, ReceiverState
+
+rdt.DEBUG = False
+
+PAYLOADS = [b"a" * 100, b"bb" * 70, b"c" * 30, b"dd" * 50]  # 长度不一样，校验包要按最长的补 0
+
+
+def parity_of(payloads):
+    fec = FECController()
+    fec.k = len(payloads)
+    for seq, payload in enumerate(payloads):
+        parity = fec.add(seq, payload, flush=False)
+    assert parity is not None and parity.fec[0] == len(payloads)
+    return parity
+
+
+def received(receiver: ReceiverState) -> bytes:
+    return b"".join(bytes(chunk) for chunk in receiver.ready)
+
+
+def test_one_loss_is_repaired():
+    for lost in range(len(PAYLOADS)):
+        receiver = ReceiverState()
+        with receiver.lock:
+            for seq, payload in enumerate(PAYLOADS):
+                if seq != lost:
+                    receiver.put(seq, payload)
+            assert receiver.add_parity(parity_of(PAYLOADS))
+        assert receiver.recv_base == len(PAYLOADS)
+        assert received(receiver) == b"".join(PAYLOADS)
+        assert not receiver.parities
+
+
+def test_two_losses_are_deferred():
+    receiver = ReceiverState()
+    with receiver.lock:
+        receiver.put(0, PAYLOADS[0])
+        receiver.put(3, PAYLOADS[3])
+        assert not receiver.add_parity(parity_of(PAYLOADS))
+        assert receiver.recv_base == 1
+        assert 0 in receiver.parities  # 校验包留着
+
+        receiver.put(2, PAYLOADS[2])  # 重传的包到了，现在只缺一个
+        assert receiver.repair(2)
+    assert receiver.recv_base == len(PAYLOADS)
+    assert received(receiver) == b"".join(PAYLOADS)
+
+
+def test_complete_group_needs_no_repair():
+    receiver = ReceiverState()
+    with receiver.lock:
+        for seq, payload in enumerate(PAYLOADS):
+            receiver.put(seq, payload)
+        assert not receiver.add_parity(parity_of(PAYLOADS))
+    assert received(receiver) == b"".join(PAYLOADS)
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
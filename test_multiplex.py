@@ -0,0 +1,98 @@
+"""
+单端口多路复用的测试: 进程里起一个会丢包的 network (跟 network.py 一样转发 8 byte 地址头)，
+几个 client 连同一个 multiplex=True 的 server 做 echo，所有连接共用一个计时器线程
+
+python -m pytest test_multiplex.py
+"""
+
+import itertools
+import threading
+import time
+from socket import socket, AF_INET, SOCK_DGRAM
+
+import rdt
+import USocket
+from USocket import addr_to_bytes, bytes_to_addr
+from rdt import RDTSocket
+
+rdt.DEBUG = False
+
+CLIENTS = 4
+DATA = bytes(range(256)) * 64
+TIMEOUT = 30
+
+
+class LossyNetwork:
+    """每 DROP_EVERY 个包丢一个，丢的包只能靠计时器 (超时重传、延迟 ack) 补回来"""
+
+    DROP_EVERY = 7
+
+    def __init__(self):
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self._counter = itertools.count(1)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                data, frm = self.sock.recvfrom(8192)
+            except OSError:
+                return
+            if next(self._counter) % self.DROP_EVERY:
+                self.sock.sendto(addr_to_bytes(frm) + data[8:], bytes_to_addr(data[:8]))
+
+
+def echo(conn, failing: bool):
+    if failing:
+        def fail(key):
+            raise RuntimeError("broken timer callback")
+
+        conn._scheduler.schedule("fail", 0, fail)
+    while True:
+        data = conn.recv(4096)
+        if not data:
+            break
+        conn.send(data)
+    conn.close()
+
+
+def client(address, results, i):
+    sock = RDTSocket()
+    sock.connect(address)
+    sock.send(DATA)
+    echoed = b""
+    while len(echoed) < len(DATA):
+        echoed += sock.recv(4096)
+    results[i] = echoed == DATA
+    sock.close()
+
+
+def test_failing_timer_callback_does_not_stop_other_connections():
+    original = USocket.network
+    network = LossyNetwork()
+    USocket.network = network.sock.getsockname()
+    server = RDTSocket(multiplex=True)
+    try:
+        server.bind(("127.0.0.1", 0))
+        results = [None] * CLIENTS
+        clients = [threading.Thread(target=client, args=(server.getsockname(), results, i), daemon=True)
+                   for i in range(CLIENTS)]
+        for thread in clients:
+            thread.start()
+        for i in range(CLIENTS):
+            conn, addr = server.accept()
+            threading.Thread(target=echo, args=(conn, i == 0), daemon=True).start()
+        deadline = time.monotonic() + TIMEOUT
+        for thread in clients:
+            thread.join(max(0, deadline - time.monotonic()))
+        assert results == [True] * CLIENTS
+    finally:
+        server.close()
+        network.sock.close()
+        USocket.network = original
+
+
+if __name__ == "__main__":
+    test_failing_timer_callback_does_not_stop_other_connections()
+    print("test_failing_timer_callback_does_not_stop_other_connections ok")
@@ -0,0 +1,130 @@
+"""
+Segment 编解码的测试: 正常的包编了再解回来字段不变，坏的、截断的包 decode 返回 None，不抛异常
+收包线程对每个包都是先 check_checksum 再 decode，所以这里坏包的 checksum 都是对的 (with_checksum 补上)
+
+python -m pytest test_segment.py
+"""
+
+import struct
+
+import rdt
+from rdt import Segment, ones_complement_sum, OPTION, WINDOW_OPTION
+
+rdt.DEBUG = False
+
+V = Segment.VERSION
+
+
+def with_checksum(data) -> bytes:
+    """前两个 byte 填上 checksum，让 check_checksum 能过"""
+    data = bytearray(data)
+    data[0:2] = b"\0\0"
+    data[0:2] = struct.pack("!H", ~ones_complement_sum(data) & 0xFFFF)
+    assert Segment.check_checksum(data)
+    return bytes(data)
+
+
+def compact(flags, options=b"", payload=b"") -> bytes:
+    """新格式的包: 15 byte header (seq_num=7, ack_num=3, conn_id=5) 后面直接接 options 和 payload"""
+    return with_checksum(struct.pack("!HBIII", 0, V << 4 | flags, 7, 3, 5) + options + payload)
+
+
+def roundtrip(segment: Segment, version: int) -> Segment:
+    data = segment.encode(version)
+    assert Segment.check_checksum(data)
+    decoded = Segment.decode(data)
+    assert decoded is not None
+    return decoded
+
+
+def test_data_roundtrip():
+    for version in (Segment.LEGACY_VERSION, V):
+        decoded = roundtrip(Segment(seq_num=42, payload=b"hello", conn_id=9), version)
+        assert decoded.is_data()
+        assert (decoded.seq_num, decoded.conn_id, bytes(decoded.payload)) == (42, 9, b"hello")
+
+
+def test_ack_roundtrip():
+    sack = Segment.encode_sack([True, False, True])
+    decoded = roundtrip(Segment.data_ack(10, sack, conn_id=3, window=17), V)
+    assert decoded.is_ack()
+    assert (decoded.ack_num, bytes(decoded.sack), decoded.window) == (10, sack, 17)
+    assert decoded.sacked() == [11, 13]
+
+
+def test_handshake_roundtrip():
+    for version in (Segment.LEGACY_VERSION, V):
+        decoded = roundtrip(Segment.synack_handshake(mss=4000, compression=0x16), version)
+        assert decoded.is_synack_handshake()
+        assert (decoded.mss, decoded.compression) == (4000, 0x16)
+
+
+def test_piggyback_roundtrip():
+    segment = Segment(seq_num=5, payload=b"abc", ack=True, ack_num=8, window=30)
+    decoded = roundtrip(segment, V)
+    assert decoded.is_data() and decoded.ack
+    assert (decoded.ack_num, decoded.window, bytes(decoded.payload)) == (8, 30, b"abc")
+
+
+def test_mss_probe_roundtrip():
+    decoded = roundtrip(Segment.mss_probe(6, bytes(100)), V)
+    assert decoded.is_mss_probe() and not decoded.is_data() and not decoded.is_syn_handshake()
+    decoded = roundtrip(Segment.mss_probe_ack(6), V)
+    assert decoded.is_mss_probe_ack() and decoded.seq_num == 6
+
+
+def test_unknown_option_skipped():
+    decoded = Segment.decode(compact(Segment.EXT, bytes([99, 2, 1, 2, Segment.OPT_END]), b"data"))
+    assert decoded is not None
+    assert bytes(decoded.payload) == b"data"
+
+
+def test_shorter_than_header():
+    for data in (b"", b"\xff\xff", bytes(10), with_checksum(bytes(14))):
+        assert Segment.decode(data) is None
+
+
+def test_truncated_legacy_header():
+    # 第 3 个 byte 的高 4 位是 0 就是老格式，要 21 byte
+    assert Segment.decode(with_checksum(bytes(18))) is None
+    data = Segment(seq_num=1, payload=b"x").encode(Segment.LEGACY_VERSION)
+    assert Segment.decode(data[:Segment.HEADER_SIZE - 1]) is None
+
+
+def test_missing_option_end():
+    assert Segment.decode(compact(Segment.EXT)) is None
+    assert Segment.decode(compact(Segment.EXT, OPTION.pack(Segment.OPT_WINDOW, 2) + WINDOW_OPTION.pack(1))) is None
+
+
+def test_option_beyond_end():
+    assert Segment.decode(compact(Segment.EXT, OPTION.pack(Segment.OPT_SACK, 10) + b"\1\2")) is None
+    assert Segment.decode(compact(Segment.EXT, bytes([Segment.OPT_WINDOW]))) is None
+
+
+def test_option_value_too_short():
+    for kind in (Segment.OPT_MSS, Segment.OPT_FEC, Segment.OPT_COMPRESSION, Segment.OPT_WINDOW):
+        assert Segment.decode(compact(Segment.EXT, OPTION.pack(kind, 0) + bytes([Segment.OPT_END]))) is None
+    data = compact(Segment.EXT | Segment.SYN, OPTION.pack(Segment.OPT_MSS, 1) + b"\1" + bytes([Segment.OPT_END]))
+    assert Segment.decode(data) is None
+
+
+def test_truncated_encoded_segments():
+    # 正常编出来的包从任何地方截断，都不能抛异常
+    segments = [
+        Segment.data_ack(10, Segment.encode_sack([True] * 20), window=17),
+        Segment.syn_handshake(mss=Segment.MAX_MSS, compression=0x16),
+        Segment(seq_num=5, payload=b"abc", ack=True, ack_num=8, window=30),
+        Segment(seq_num=3, payload=bytes(6), fec=(4, 6)),
+    ]
+    for segment in segments:
+        for version in (Segment.LEGACY_VERSION, V):
+            data = segment.encode(version)
+            for size in range(len(data)):
+                Segment.decode(data[:size])  # None 或者一个短一点的包，都行
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
@@ -0,0 +1,72 @@
+"""
+SenderState 分段的测试: MSS 探测成功以后 set_mss 把还没发的数据按新的包长重新切，已经发了的包不动
+
+python -m pytest test_sender.py
+"""
+
+import rdt
+from rdt import SenderState, Segment
+
+rdt.DEBUG = False
+
+MSS = Segment.MAX_PAYLOAD_SIZE
+DATA = bytes(i % 251 for i in range(5 * MSS + 123))
+
+
+def segments(sender: SenderState) -> list:
+    return [bytes(sender.payload(seq)) for seq in range(sender.total_segments)]
+
+
+def send(sender: SenderState, count: int):
+    for _ in range(count):
+        sender.new_segment()
+
+
+def test_partly_sent_chunk_is_split_again():
+    sender = SenderState()
+    sender.push(DATA)
+    assert sender.total_segments == 6
+    send(sender, 2)
+
+    sender.set_mss(2 * MSS)
+    payloads = segments(sender)
+    assert payloads[:2] == [DATA[:MSS], DATA[MSS:2 * MSS]]  # 发了的包不动
+    assert [len(payload) for payload in payloads[2:]] == [2 * MSS, MSS + 123]
+    assert b"".join(payloads) == DATA
+    assert sender.total_bytes == len(DATA)
+    assert sender.offset(2) == 2 * MSS and sender.offset(3) == 4 * MSS
+    assert sender.offset(sender.total_segments) == len(DATA)
+
+
+def test_unsent_chunks_after_the_split_are_kept_in_order():
+    sender = SenderState()
+    sender.push(DATA[:3 * MSS])
+    sender.push(DATA[3 * MSS:])
+    send(sender, 1)
+
+    sender.set_mss(3 * MSS)
+    payloads = segments(sender)
+    assert [len(payload) for payload in payloads] == [MSS, 2 * MSS, 2 * MSS + 123]
+    assert b"".join(payloads) == DATA
+
+
+def test_fully_sent_chunk_is_not_touched():
+    sender = SenderState()
+    sender.push(DATA[:2 * MSS])
+    send(sender, 2)
+    sender.push(DATA[2 * MSS:])
+
+    sender.set_mss(4 * MSS)
+    payloads = segments(sender)
+    assert [len(payload) for payload in payloads] == [MSS, MSS, 3 * MSS + 123]
+    assert b"".join(payloads) == DATA
+
+    sender.set_mss(4 * MSS)  # 没变就什么都不做
+    assert segments(sender) == payloads
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
@@ -0,0 +1,40 @@
+"""
+UnreliableSocket 限速的测试: 用一个本地的 UDP socket 冒充 network，看 sendto() 真正发出去的是什么
+
+python -m pytest test_usocket.py
+"""
+
+from socket import socket, AF_INET, SOCK_DGRAM
+
+import USocket
+from USocket import UnreliableSocket, MIN_BURST
+
+
+def fake_network() -> socket:
+    network = socket(AF_INET, SOCK_DGRAM)
+    network.bind(("127.0.0.1", 0))
+    network.settimeout(3)
+    USocket.network = network.getsockname()
+    return network
+
+
+def test_queued_memoryview_is_copied():
+    original = USocket.network
+    network = fake_network()
+    sock = UnreliableSocket(rate=1000)
+    try:
+        sock.sendto(bytes(MIN_BURST), ("127.0.0.1", 1))  # 把令牌用光
+        buffer = bytearray(b"a" * 20)
+        sock.sendto(memoryview(buffer), ("127.0.0.1", 1))  # 令牌不够，小包排队
+        buffer[:] = b"b" * 20  # 像下一次 encode 一样改掉缓冲区
+        assert network.recv(MIN_BURST + 8)[8:] == bytes(MIN_BURST)
+        assert network.recv(100)[8:] == b"a" * 20
+    finally:
+        sock.close()
+        network.close()
+        USocket.network = original
+
+
+if __name__ == "__main__":
+    test_queued_memoryview_is_copied()
+    print("test_queued_memoryview_is_copied ok")